@@ -0,0 +1,94 @@
+'''CPU cost of feeding icom listeners: shared `ListenHub` versus one `AudioDrain` per listener.
+
+Run from the root of a set up instance (data/ and static/ present): python -m benchmarks.listen_hub
+'''
+import asyncio
+import time
+
+import numpy as np
+from wauxio import Audio, StreamData
+from wauxio.utils import AudioDrain
+
+from bmaster.icoms import hubs
+
+
+RATE = 48000
+TICK_SAMPLES = 480
+CHUNK_SIZE = 4800
+SECONDS = 20
+LISTENERS = (1, 10, 100)
+
+
+class FakeOutput:
+	'''Stands in for `AudioOutput`, only the rate and the listener list are used'''
+	rate = RATE
+
+	def __init__(self):
+		self.outputs = []
+
+	def listen(self, fn):
+		self.outputs.append(fn)
+
+	def emit(self, frame: StreamData):
+		for fn in self.outputs:
+			fn(frame)
+
+
+async def _sink(data: bytes):
+	pass
+
+
+async def _drive(output: FakeOutput):
+	frame = StreamData(Audio(np.zeros((TICK_SAMPLES, 1), dtype=np.float32), RATE))
+	for _ in range(SECONDS * RATE // TICK_SAMPLES):
+		output.emit(frame)
+		await asyncio.sleep(0)
+
+
+async def bench_per_listener(listeners: int) -> float:
+	output = FakeOutput()
+	loop = asyncio.get_running_loop()
+
+	def _write(frame: StreamData):
+		audio = frame.audio
+		if not audio: return
+		loop.create_task(_sink(audio.data.tobytes()))
+
+	for _ in range(listeners):
+		drain = AudioDrain(rate=RATE, channels=1, samples=CHUNK_SIZE, output=_write)
+		output.listen(drain.push)
+
+	start = time.process_time()
+	await _drive(output)
+	return time.process_time() - start
+
+
+async def bench_hub(listeners: int) -> float:
+	output = FakeOutput()
+	hub = hubs.get_hub(output, hubs.ListenKey(rate=RATE, channels=1, chunk_size=CHUNK_SIZE))
+	subscribers = [hub.subscribe() for _ in range(listeners)]
+
+	async def _consume(subscriber: hubs.ListenSubscriber):
+		while True:
+			await _sink(await subscriber.get())
+
+	tasks = [asyncio.create_task(_consume(s)) for s in subscribers]
+	start = time.process_time()
+	await _drive(output)
+	elapsed = time.process_time() - start
+	for task in tasks: task.cancel()
+	for subscriber in subscribers: subscriber.close()
+	return elapsed
+
+
+async def main():
+	print(f'{SECONDS} s of audio, {CHUNK_SIZE} samples per chunk, CPU ms per audio second')
+	print(f'{"listeners":>10} {"per-listener":>14} {"hub":>10}')
+	for listeners in LISTENERS:
+		legacy = await bench_per_listener(listeners)
+		shared = await bench_hub(listeners)
+		print(f'{listeners:>10} {legacy / SECONDS * 1000:>14.2f} {shared / SECONDS * 1000:>10.2f}')
+
+
+if __name__ == '__main__':
+	asyncio.run(main())
@@ -8,6 +8,8 @@ from bmaster.logs import main_logger
 import bmaster.configs
 import bmaster.database
 import bmaster.direct
+import bmaster.recording
+import bmaster.volume
 import bmaster.sounds
 import bmaster.icoms
 import bmaster.scheduling
@@ -25,6 +27,8 @@ async def start():
 	bmaster.configs.load_configs()
 	await bmaster.database.start()
 	await bmaster.direct.start()
+	await bmaster.recording.start()
+	await bmaster.volume.start()
 	await bmaster.sounds.start()
 	await bmaster.icoms.start()
 	await bmaster.scheduling.start()
@@ -35,6 +39,7 @@ async def start():
 
 	# POST START
 	await bmaster.database.update_models()
+	await bmaster.volume.load()
 	
 	main_logger.info('Started')
 
@@ -18,21 +18,26 @@ async def start():
 
     import bmaster.api.icoms
     import bmaster.api.icoms.listen
+    import bmaster.api.icoms.live
+    import bmaster.api.icoms.meters
     import bmaster.api.icoms.queries
     import bmaster.api.icoms.queries.audio
     import bmaster.api.icoms.queries.sound
     import bmaster.api.icoms.queries.stream
+    import bmaster.api.icoms.queries.rtp
 
     from bmaster.api import scripting
     from bmaster.api import sounds
     from bmaster.api import settings
     from bmaster.api import certs
+    from bmaster.api import direct
 
     logger.info("Including routers...")
 
     api.include_router(sounds.router, prefix="/sounds")
     api.include_router(settings.router, prefix="/settings")
     api.include_router(certs.router, prefix="/certs")
+    api.include_router(direct.router, prefix="/direct")
 
     @api.get("/{full_path:path}")
     async def not_found():
@@ -40,4 +45,6 @@ async def start():
 
     app.include_router(api, prefix="/api")
 
+    await bmaster.api.icoms.queries.rtp.start()
+
     logger.info("Started")
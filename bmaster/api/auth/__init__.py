@@ -1,5 +1,6 @@
 from typing import Annotated, Any, Coroutine, Literal, Optional, Self, Type
-from fastapi import Depends, HTTPException, status
+from fastapi import Depends, HTTPException, WebSocket, status
+from fastapi.requests import HTTPConnection
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from pydantic import AfterValidator, BaseModel, Field, ModelWrapValidatorHandler, SerializeAsAny, ValidationError, field_validator, model_validator
 
@@ -134,6 +135,43 @@ def require_permissions(*permissions: str):
 			raise HTTPException(status.HTTP_403_FORBIDDEN, 'bmaster.auth.missing_permissions')
 	return _check
 
+def get_connection_token(conn: HTTPConnection) -> Optional[str]:
+	'''Bearer token from the Authorization header, or from the token query parameter
+	for clients that can not set headers, like browser websockets and media players'''
+	auth_header = conn.headers.get('authorization')
+	if auth_header:
+		scheme, _, token = auth_header.partition(' ')
+		if scheme.lower() == 'bearer' and token:
+			return token
+		if scheme and not token:
+			# Allow raw token in header for non-standard clients.
+			return scheme
+	return conn.query_params.get('token')
+
+async def require_connection_user(conn: HTTPConnection) -> User:
+	'''Same as require_user, also accepting the token as a query parameter'''
+	token = get_connection_token(conn)
+	if not token:
+		raise HTTPException(
+			status.HTTP_401_UNAUTHORIZED, 'missing bearer token',
+			headers={'WWW-Authenticate': 'Bearer'}
+		)
+	return await require_user(require_auth_token(require_bearer_jwt(token)))
+
+async def require_ws_user(ws: WebSocket, *permissions: str) -> Optional[User]:
+	'''Authenticates an accepted websocket, None after sending the error and closing it'''
+	try:
+		user = await require_connection_user(ws)
+		require_permissions(*permissions)(user)
+		return user
+	except HTTPException as e:
+		await ws.send_json({
+			'type': 'error',
+			'error': e.detail,
+		})
+		await ws.close(code=status.WS_1008_POLICY_VIOLATION)
+		return None
+
 async def start():
 	global config, hasher
 	config = AuthConfig.model_validate(configs.main_config['auth'])
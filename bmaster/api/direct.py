@@ -0,0 +1,12 @@
+from fastapi import APIRouter, Depends
+
+from bmaster import direct
+from bmaster.api.auth import require_permissions
+
+
+router = APIRouter(tags=["direct"])
+
+
+@router.get("/stats", dependencies=[Depends(require_permissions("bmaster.icoms.read"))])
+async def get_direct_stats() -> direct.DirectStats:
+    return direct.get_stats()
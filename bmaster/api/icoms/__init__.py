@@ -1,5 +1,8 @@
 from typing import Annotated
-from fastapi import Depends, HTTPException, status
+from fastapi import Depends, HTTPException, Query, Response, status
+from pydantic import BaseModel, Field
+
+from bmaster import volume
 
 from bmaster.api import api
 from bmaster.api.auth import require_user
@@ -8,6 +11,10 @@ from bmaster.api.icoms.auth import has_icom_permissions
 import bmaster.icoms as icoms
 
 
+class IcomVolume(BaseModel):
+	volume: int = Field(..., ge=0, le=100)
+
+
 @api.get('/icoms/{icom_id}', tags=['icoms'])
 async def get_icom(icom_id: str, user: Annotated[Account, Depends(require_user)]) -> icoms.IcomInfo:
 	icom = icoms.get(icom_id)
@@ -24,3 +31,43 @@ async def get_icoms(user: Annotated[Account, Depends(require_user)]) -> dict[str
 		if await has_icom_permissions(icom, user, 'bmaster.icoms.read'):
 			res[icom.id] = icom.get_info()
 	return res
+
+@api.get('/icoms/{icom_id}/replay', tags=['icoms'], response_class=Response, responses={
+	200: {'content': {'audio/wav': {}}}
+})
+async def replay_icom(
+	icom_id: str,
+	user: Annotated[Account, Depends(require_user)],
+	seconds: Annotated[float, Query(gt=0)] = 10.0
+) -> Response:
+	icom = icoms.get(icom_id)
+	if not icom: raise HTTPException(status.HTTP_404_NOT_FOUND, 'Icom not found')
+	if not await has_icom_permissions(icom, user, 'bmaster.icoms.read'):
+		raise HTTPException(status.HTTP_404_NOT_FOUND, 'Icom not found')
+	history = icom.history
+	if history is None:
+		raise HTTPException(status.HTTP_404_NOT_FOUND, 'Icom history is disabled')
+	return Response(
+		content=history.to_wav(seconds),
+		media_type='audio/wav',
+		headers={'Content-Disposition': f'attachment; filename="{icom.id}-replay.wav"'}
+	)
+
+@api.get('/icoms/{icom_id}/volume', tags=['icoms'])
+async def get_icom_volume(icom_id: str, user: Annotated[Account, Depends(require_user)]) -> IcomVolume:
+	icom = icoms.get(icom_id)
+	if not icom: raise HTTPException(status.HTTP_404_NOT_FOUND, 'Icom not found')
+	if not await has_icom_permissions(icom, user, 'bmaster.icoms.read'):
+		raise HTTPException(status.HTTP_404_NOT_FOUND, 'Icom not found')
+	return IcomVolume(volume=volume.get_icom(icom))
+
+@api.put('/icoms/{icom_id}/volume', tags=['icoms'])
+async def set_icom_volume(icom_id: str, req: IcomVolume, user: Annotated[Account, Depends(require_user)]) -> IcomVolume:
+	icom = icoms.get(icom_id)
+	if not icom: raise HTTPException(status.HTTP_404_NOT_FOUND, 'Icom not found')
+	if not await has_icom_permissions(icom, user, 'bmaster.icoms.read'):
+		raise HTTPException(status.HTTP_404_NOT_FOUND, 'Icom not found')
+	if not await has_icom_permissions(icom, user, 'bmaster.icoms.volume'):
+		raise HTTPException(status.HTTP_403_FORBIDDEN, 'bmaster.auth.missing_permissions')
+	await volume.set_icom(icom, req.volume)
+	return req
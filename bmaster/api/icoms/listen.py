@@ -1,20 +1,32 @@
 import asyncio
-from typing import Optional
-from pydantic import BaseModel, ValidationError
-from fastapi import WebSocket, WebSocketDisconnect
-from wauxio import StreamData
-from wauxio.utils import AudioDrain
+import shutil
+from typing import Annotated, Optional
+from pydantic import BaseModel, Field, ValidationError
+from fastapi import Depends, HTTPException, WebSocket, WebSocketDisconnect, status
 
 from bmaster.server import app
-from bmaster import icoms
+from bmaster import direct, icoms
+from bmaster.icoms import hubs
 from bmaster.api import api
+from bmaster.api.auth import require_user, require_ws_user
+from bmaster.api.auth.users import Account
+from bmaster.api.icoms.auth import has_icom_permissions
 
 
 class APIListenRequest(BaseModel):
-	icom: str
-	rate: Optional[int] = None
+	icom: Optional[str] = None
+	# Listen to the combined direct output mix instead of an icom
+	direct: bool = False
+	rate: Optional[int] = Field(default=None, ge=hubs.LISTEN_MIN_RATE, le=192000)
 	channels: Optional[int] = None
-	chunk_size: int
+	chunk_size: int = Field(gt=0)
+	overflow: Optional[hubs.OverflowPolicy] = None
+	encoding: hubs.ListenEncoding = 'pcm'
+	format: hubs.ListenFormat = 'f32'
+	# Seconds of recent audio to start with, defaults to icoms.listen.preroll_seconds
+	preroll: Optional[float] = Field(default=None, ge=0, le=10)
+	# Opus bitrate in bits per second
+	bitrate: int = Field(default=24000, ge=6000, le=510000)
 
 
 
@@ -34,57 +46,163 @@ async def listen_icom(ws: WebSocket):
 			await ws.close()
 			return
 
-		icom = icoms.get(request.icom)
-		if not icom:
+		if request.direct:
+			# The direct mix carries every direct icom, it is not open like single icoms
+			if not await require_ws_user(ws, 'bmaster.direct.listen'):
+				return
+			if direct.config.devices:
+				await ws.send_json({
+					'type': 'error',
+					'error': 'direct output is routed per device channel, listen to the icoms instead'
+				})
+				await ws.close()
+				return
+			source = direct.output
+			history = None
+		else:
+			icom = icoms.get(request.icom) if request.icom else None
+			if not icom:
+				await ws.send_json({
+					'type': 'error',
+					'error': 'icom not found'
+				})
+				await ws.close()
+				return
+			source = icom.output
+			history = icom.history
+
+		channels = request.channels or source.channels
+		# TODO: Implement channel remixing
+		if channels != source.channels:
 			await ws.send_json({
 				'type': 'error',
-				'error': 'icom not found'
+				'error': f'only {source.channels} channel(s) supported'
 			})
 			await ws.close()
+			return
+		
+		rate = request.rate or source.rate
 
-		icom_output = icom.output
-
-		channels = request.channels or icom_output.channels
-		# TODO: Implement multi-channels
-		if channels != 1:
+		chunk_size = request.chunk_size
+		if not rate * hubs.LISTEN_MIN_CHUNK_SECONDS <= chunk_size <= rate * hubs.LISTEN_MAX_CHUNK_SECONDS:
 			await ws.send_json({
 				'type': 'error',
-				'error': 'only 1 channel supported'
+				'error': f'chunk_size must be between {hubs.LISTEN_MIN_CHUNK_SECONDS * 1000:g} ms and {hubs.LISTEN_MAX_CHUNK_SECONDS:g} s of audio'
 			})
 			await ws.close()
-		
-		rate = request.rate or icom_output.rate
+			return
 
-		chunk_size = request.chunk_size
+		encoding = request.encoding
+		bitrate = request.bitrate if encoding == 'opus' else None
+		sample_format = request.format
+		if encoding == 'opus':
+			# The encoder takes the output as is, opus always decodes to 48 kHz
+			rate = source.rate
+			sample_format = 'f32'
+		if encoding == 'opus' and not shutil.which('ffmpeg'):
+			await ws.send_json({
+				'type': 'error',
+				'error': 'ffmpeg is required for opus encoding but is not installed'
+			})
+			await ws.close()
+			return
 
 		await ws.send_json({
 			'type': 'listening',
 			'rate': rate,
 			'channels': channels,
-			'chunk_size': chunk_size
+			'chunk_size': chunk_size,
+			'encoding': encoding,
+			'format': sample_format,
+			'bitrate': bitrate
 		})
 	except WebSocketDisconnect: return
 	
 	
-	loop = asyncio.get_running_loop()
-	# IAudioWriter
-	def _write(frame: StreamData):
-		audio = frame.audio
-		if not audio: return
-		loop.create_task(ws.send_bytes(audio.data.tobytes())).add_done_callback(lambda t: None)
-	
-	drain = AudioDrain(
+	listen_config = icoms.config.listen
+	hub = hubs.get_hub(source, hubs.ListenKey(
 		rate=rate,
 		channels=channels,
-		samples=chunk_size,
-		output=_write
+		chunk_size=chunk_size,
+		encoding=encoding,
+		format=sample_format,
+		bitrate=bitrate
+	), history)
+	subscriber = hub.subscribe(
+		max_chunks=listen_config.queue_chunks,
+		overflow=request.overflow or listen_config.overflow,
+		preroll=request.preroll if request.preroll is not None else listen_config.preroll_seconds
 	)
+	send_task: Optional[asyncio.Task] = None
+
+	async def _send():
+		nonlocal subscriber
+		try:
+			while True:
+				try:
+					chunk = await subscriber.get()
+				except hubs.ListenError as e:
+					await ws.send_json({
+						'type': 'error',
+						'error': str(e)
+					})
+					await ws.close()
+					return
+				except hubs.ListenOverflow:
+					lower = hubs.downgrade(subscriber) if subscriber.overflow == 'downgrade' else None
+					if lower is None:
+						await ws.send_json({
+							'type': 'error',
+							'error': 'listener is too slow',
+							'stats': subscriber.get_info().model_dump(mode='json')
+						})
+						await ws.close()
+						return
+					subscriber = lower
+					key = lower.hub.key
+					await ws.send_json({
+						'type': 'listening',
+						'rate': key.rate,
+						'channels': key.channels,
+						'chunk_size': key.chunk_size,
+						'encoding': key.encoding,
+						'format': key.format,
+						'bitrate': key.bitrate,
+						'downgraded': True
+					})
+					continue
+				await ws.send_bytes(chunk)
+		except (WebSocketDisconnect, RuntimeError):
+			pass
 
-	icom.output.listen(drain.push)
+	try:
+		send_task = asyncio.create_task(_send())
+		while True:
+			try: msg = await ws.receive_json()
+			except WebSocketDisconnect: break
+			except RuntimeError: break
+			except ValueError: continue
+			if isinstance(msg, dict) and msg.get('type') == 'stats':
+				await ws.send_json({
+					'type': 'stats',
+					'stats': subscriber.get_info().model_dump(mode='json')
+				})
+	except WebSocketDisconnect:
+		pass
+	finally:
+		if send_task is not None:
+			send_task.cancel()
+		subscriber.close()
 
-	while True:
-		try: msg = await ws.receive_json()
-		except WebSocketDisconnect: break
-		except RuntimeError: break
 
-	icom.output.outputs.remove(drain.push)
+@api.get('/icoms/{icom_id}/listeners', tags=['icoms'])
+async def get_icom_listeners(icom_id: str, user: Annotated[Account, Depends(require_user)]) -> list[hubs.ListenerInfo]:
+	icom = icoms.get(icom_id)
+	if not icom: raise HTTPException(status.HTTP_404_NOT_FOUND, 'Icom not found')
+	if not await has_icom_permissions(icom, user, 'bmaster.icoms.read'):
+		raise HTTPException(status.HTTP_404_NOT_FOUND, 'Icom not found')
+	return [
+		subscriber.get_info()
+		for hub in hubs.get_hubs(icom.output)
+		for subscriber in hub.subscribers
+	]
@@ -0,0 +1,145 @@
+import shutil
+import struct
+from typing import Annotated, AsyncIterator, Literal, Optional
+from fastapi import Depends, HTTPException, Query, status
+from fastapi.responses import StreamingResponse
+from wauxio.output import AudioOutput
+
+from bmaster import direct, icoms
+from bmaster.icoms import hubs
+from bmaster.icoms.history import AudioHistory
+from bmaster.api import api
+from bmaster.api.auth import require_connection_user, require_permissions
+from bmaster.api.auth.users import Account
+from bmaster.api.icoms.auth import has_icom_permissions
+
+
+# Duration of one WAV chunk sent to live clients
+LIVE_CHUNK_SECONDS = 0.1
+# RIFF sizes announced for an endless stream
+WAV_STREAM_SIZE = 0xFFFFFFFF
+
+LiveFormat = Literal['opus', 'wav']
+
+_LIVE_MEDIA_TYPES: dict[LiveFormat, str] = {
+	'opus': 'audio/ogg',
+	'wav': 'audio/wav',
+}
+
+# Open live responses per target
+_live_clients: dict[str, int] = dict()
+
+
+def _wav_header(rate: int, channels: int) -> bytes:
+	'''s16 WAV header of unknown length, players read until the connection ends'''
+	block_align = channels * 2
+	return b''.join((
+		b'RIFF', struct.pack('<I', WAV_STREAM_SIZE), b'WAVE',
+		b'fmt ', struct.pack('<IHHIIHH', 16, 1, channels, rate, rate * block_align, block_align, 16),
+		b'data', struct.pack('<I', WAV_STREAM_SIZE - 36)
+	))
+
+
+async def _iter_live(
+	target: str,
+	output: AudioOutput,
+	key: hubs.ListenKey,
+	history: Optional[AudioHistory],
+	header: bytes
+) -> AsyncIterator[bytes]:
+	# Subscribed on the first iteration, a client gone before the body starts leaves nothing behind
+	listen_config = icoms.config.listen
+	if _live_clients.get(target, 0) >= listen_config.live_max_clients:
+		return
+	# A live stream can not change its format midway, slow clients just lose audio
+	subscriber = hubs.get_hub(output, key, history).subscribe(
+		max_chunks=listen_config.queue_chunks,
+		overflow='drop_oldest'
+	)
+	_live_clients[target] = _live_clients.get(target, 0) + 1
+	try:
+		if header:
+			yield header
+		while True:
+			yield await subscriber.get()
+	except hubs.ListenError:
+		# Ends the response, players see the stream close
+		return
+	finally:
+		subscriber.close()
+		_live_clients[target] -= 1
+		if not _live_clients[target]:
+			del _live_clients[target]
+
+
+def live_response(
+	target: str,
+	output: AudioOutput,
+	history: Optional[AudioHistory],
+	format: LiveFormat,
+	rate: Optional[int],
+	bitrate: int
+) -> StreamingResponse:
+	'''Serves an audio output as an endless HTTP stream from the shared listen hubs'''
+	listen_config = icoms.config.listen
+	if _live_clients.get(target, 0) >= listen_config.live_max_clients:
+		raise HTTPException(status.HTTP_503_SERVICE_UNAVAILABLE, 'Too many live clients')
+
+	channels = output.channels
+	if format == 'opus':
+		if not shutil.which('ffmpeg'):
+			raise HTTPException(status.HTTP_503_SERVICE_UNAVAILABLE, 'ffmpeg is required for opus encoding but is not installed')
+		key = hubs.ListenKey(
+			rate=output.rate,
+			channels=channels,
+			chunk_size=max(1, int(output.rate * LIVE_CHUNK_SECONDS)),
+			encoding='opus',
+			bitrate=bitrate
+		)
+		header = b''
+	else:
+		rate = rate or output.rate
+		key = hubs.ListenKey(
+			rate=rate,
+			channels=channels,
+			chunk_size=max(1, int(rate * LIVE_CHUNK_SECONDS)),
+			format='s16'
+		)
+		header = _wav_header(rate, channels)
+
+	return StreamingResponse(
+		_iter_live(target, output, key, history, header),
+		media_type=_LIVE_MEDIA_TYPES[format],
+		headers={'Cache-Control': 'no-store'}
+	)
+
+
+@api.get('/icoms/{icom_id}/live', tags=['icoms'], response_class=StreamingResponse, responses={
+	200: {'content': {media_type: {} for media_type in _LIVE_MEDIA_TYPES.values()}}
+})
+async def live_icom(
+	icom_id: str,
+	user: Annotated[Account, Depends(require_connection_user)],
+	format: LiveFormat = 'opus',
+	rate: Annotated[Optional[int], Query(ge=hubs.LISTEN_MIN_RATE, le=192000)] = None,
+	bitrate: Annotated[int, Query(ge=6000, le=510000)] = 24000
+) -> StreamingResponse:
+	icom = icoms.get(icom_id)
+	if not icom: raise HTTPException(status.HTTP_404_NOT_FOUND, 'Icom not found')
+	if not await has_icom_permissions(icom, user, 'bmaster.icoms.read'):
+		raise HTTPException(status.HTTP_404_NOT_FOUND, 'Icom not found')
+	return live_response(f'icom:{icom.id}', icom.output, icom.history, format, rate, bitrate)
+
+@api.get('/direct/live', tags=['direct'], response_class=StreamingResponse, responses={
+	200: {'content': {media_type: {} for media_type in _LIVE_MEDIA_TYPES.values()}}
+})
+async def live_direct(
+	user: Annotated[Account, Depends(require_connection_user)],
+	format: LiveFormat = 'opus',
+	rate: Annotated[Optional[int], Query(ge=hubs.LISTEN_MIN_RATE, le=192000)] = None,
+	bitrate: Annotated[int, Query(ge=6000, le=510000)] = 24000
+) -> StreamingResponse:
+	require_permissions('bmaster.direct.listen')(user)
+	if direct.config.devices:
+		raise HTTPException(status.HTTP_409_CONFLICT, 'Direct output is routed per device channel')
+	return live_response('direct', direct.output, None, format, rate, bitrate)
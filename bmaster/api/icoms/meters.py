@@ -0,0 +1,104 @@
+import asyncio
+import json
+from typing import Optional
+from fastapi import WebSocket, WebSocketDisconnect
+
+from bmaster import direct, icoms
+from bmaster.api import api
+from bmaster.api.auth import require_ws_user
+from bmaster.api.icoms.auth import has_icom_permissions
+
+
+# Level updates per second
+METERS_RATE = 10
+# Updates a viewer may fall behind before the oldest is dropped
+METERS_QUEUE = 2
+
+
+def _levels(peak: list[float], rms: list[float]) -> dict:
+	return {
+		'peak': [round(value, 4) for value in peak],
+		'rms': [round(value, 4) for value in rms]
+	}
+
+
+# Icoms a viewer may read, and whether it may see the direct devices
+MeterScope = tuple[frozenset[str], bool]
+
+
+class MetersPublisher:
+	'''Takes the levels of every icom and direct device once per update and sends one
+	message per permission scope, so the cost does not grow with the number of viewers'''
+	task: Optional[asyncio.Task] = None
+
+	def __init__(self):
+		self.viewers: dict[asyncio.Queue[str], MeterScope] = dict()
+
+	def subscribe(self, scope: MeterScope) -> asyncio.Queue[str]:
+		queue = asyncio.Queue(METERS_QUEUE)
+		self.viewers[queue] = scope
+		if self.task is None:
+			self.task = asyncio.create_task(self._run())
+		return queue
+
+	def unsubscribe(self, queue: asyncio.Queue[str]):
+		self.viewers.pop(queue, None)
+		if not self.viewers and self.task is not None:
+			self.task.cancel()
+			self.task = None
+
+	def _take(self) -> tuple[dict[str, dict], list[dict]]:
+		return (
+			{
+				icom.id: _levels(*icom.meter.take())
+				for icom in icoms._icoms_map.values()
+			},
+			[
+				{'device': device.device, **_levels(*device.meter.take())}
+				for device in direct.devices
+			]
+		)
+
+	async def _run(self):
+		# Levels accumulated while nobody watched are not interesting
+		self._take()
+		while True:
+			await asyncio.sleep(1 / METERS_RATE)
+			icom_levels, direct_levels = self._take()
+			messages: dict[MeterScope, str] = dict()
+			for queue, scope in self.viewers.items():
+				message = messages.get(scope)
+				if message is None:
+					icom_ids, show_direct = scope
+					message = messages[scope] = json.dumps({
+						'type': 'levels',
+						'icoms': {id: levels for id, levels in icom_levels.items() if id in icom_ids},
+						'direct': direct_levels if show_direct else []
+					})
+				if queue.full():
+					queue.get_nowait()
+				queue.put_nowait(message)
+
+
+publisher = MetersPublisher()
+
+
+@api.websocket('/icoms/meters')
+async def watch_meters(ws: WebSocket):
+	await ws.accept()
+	user = await require_ws_user(ws)
+	if not user:
+		return
+	icom_ids = frozenset([
+		icom.id
+		for icom in icoms._icoms_map.values()
+		if await has_icom_permissions(icom, user, 'bmaster.icoms.read')
+	])
+	queue = publisher.subscribe((icom_ids, user.has_permissions('bmaster.direct.listen')))
+	try:
+		while True:
+			await ws.send_text(await queue.get())
+	except (WebSocketDisconnect, RuntimeError):
+		pass
+	finally:
+		publisher.unsubscribe(queue)
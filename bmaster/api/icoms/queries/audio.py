@@ -10,6 +10,7 @@ from bmaster.api.auth.users import User
 from bmaster.api.icoms.queries import query_author_from_user
 import bmaster.icoms as icoms
 from bmaster.icoms.queries import AudioQuery, QueryInfo
+from bmaster.utils.audio import trim_silence
 
 
 class APIAudioRequest(BaseModel):
@@ -45,6 +46,12 @@ async def play_audio(
 	except:
 		raise HTTPException(status.HTTP_400_BAD_REQUEST, 'Failed to decode audio data')
 
+	silence_config = icoms.config.silence
+	if silence_config.trim:
+		audio_data = trim_silence(audio_data, request.rate, silence_config.threshold_db, silence_config.trim_padding)
+		if not len(audio_data):
+			raise HTTPException(status.HTTP_400_BAD_REQUEST, 'Audio is silent')
+
 	audio = Audio(
 		data=audio_data,
 		rate=request.rate
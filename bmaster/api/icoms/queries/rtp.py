@@ -0,0 +1,470 @@
+import asyncio
+import shutil
+import struct
+import time
+import uuid
+from typing import Annotated, Literal, Optional
+
+from fastapi import Depends, HTTPException, status
+from pydantic import BaseModel, Field
+from wauxio import Audio, StreamData, StreamOptions
+from wauxio.utils import AudioStack
+
+from bmaster import configs
+from bmaster.api import api
+from bmaster.api.auth import require_permissions, require_user
+from bmaster.api.auth.users import User
+from bmaster.api.icoms.queries import query_author_from_user
+from bmaster.api.icoms.queries.stream import FFmpegStreamDecoder
+from bmaster.icoms import Icom
+from bmaster.icoms.queries import PlayOptions, Query, QueryAuthor, QueryStatus
+from bmaster.logs import main_logger
+from bmaster.recording import Recording, start_recording
+from bmaster.utils import aio
+from bmaster.utils.audio import LinearResampler, decode_alaw, decode_l16, decode_ulaw
+from bmaster.utils.ogg import OggOpusWriter, opus_packet_samples
+import bmaster.icoms as icoms
+
+
+logger = main_logger.getChild('rtp')
+
+# Playback buffer of an RTP query. Packets arrive every 10-20 ms on a LAN,
+# so a few packets of slack is enough and keeps mouth-to-speaker latency low.
+RTP_STACK_SECONDS = 0.08
+RTP_IDLE_CHECK_INTERVAL = 0.05
+
+RtpCodec = Literal['pcmu', 'pcma', 'l16', 'opus']
+
+_CODEC_RATES: dict[str, int] = {
+	'pcmu': 8000,
+	'pcma': 8000,
+	'opus': 48000,
+}
+
+_RTP_HEADER = struct.Struct('!BBHII')
+
+
+class RtpEndpointConfig(BaseModel):
+	icom: str
+	host: str = '0.0.0.0'
+	port: int = Field(ge=0, le=65535)
+	codec: RtpCodec = 'pcmu'
+	# Clock rate of L16 payloads, other codecs have a fixed rate
+	rate: Optional[int] = Field(default=None, gt=0)
+	priority: int = 0
+	force: bool = False
+	# Packets held back waiting for a missing sequence number
+	reorder_depth: int = Field(default=2, ge=0)
+	# Silence after which the talk spurt query is finished
+	idle_timeout: float = Field(default=0.5, gt=0)
+
+class RtpConfig(BaseModel):
+	endpoints: dict[str, RtpEndpointConfig] = Field(default_factory=dict)
+
+config: Optional[RtpConfig] = None
+
+
+class RtpPacket:
+	__slots__ = ('payload_type', 'sequence', 'timestamp', 'ssrc', 'payload')
+
+	def __init__(self, payload_type: int, sequence: int, timestamp: int, ssrc: int, payload: bytes):
+		self.payload_type = payload_type
+		self.sequence = sequence
+		self.timestamp = timestamp
+		self.ssrc = ssrc
+		self.payload = payload
+
+def parse_rtp_packet(data: bytes) -> Optional[RtpPacket]:
+	if len(data) < _RTP_HEADER.size:
+		return None
+	flags, marker_pt, sequence, timestamp, ssrc = _RTP_HEADER.unpack_from(data)
+	if flags >> 6 != 2:
+		return None
+
+	offset = _RTP_HEADER.size + (flags & 0x0F) * 4
+	if flags & 0x10:
+		if len(data) < offset + 4:
+			return None
+		ext_words = struct.unpack_from('!H', data, offset + 2)[0]
+		offset += 4 + ext_words * 4
+
+	end = len(data)
+	if flags & 0x20:
+		end -= data[-1]
+	if end <= offset:
+		return None
+
+	return RtpPacket(marker_pt & 0x7F, sequence, timestamp, ssrc, data[offset:end])
+
+
+class RtpReorderBuffer:
+	'''Restores sequence order, waiting at most `depth` packets for a missing one'''
+	depth: int
+	next_seq: Optional[int] = None
+	lost: int = 0
+	late: int = 0
+
+	def __init__(self, depth: int):
+		self.depth = depth
+		self.pending: dict[int, RtpPacket] = dict()
+
+	def reset(self):
+		self.pending.clear()
+		self.next_seq = None
+
+	def push(self, packet: RtpPacket) -> list[RtpPacket]:
+		seq = packet.sequence
+		if self.next_seq is None:
+			self.next_seq = seq
+		elif (seq - self.next_seq) & 0xFFFF >= 0x8000:
+			self.late += 1
+			return []
+		self.pending[seq] = packet
+
+		pending = self.pending
+		res = []
+		while pending:
+			packet = pending.pop(self.next_seq, None)
+			if packet is not None:
+				res.append(packet)
+				self.next_seq = (self.next_seq + 1) & 0xFFFF
+				continue
+			if len(pending) <= self.depth:
+				break
+			# Give up on the gap and jump to the closest held packet
+			next_seq = min(pending, key=lambda s: (s - self.next_seq) & 0xFFFF)
+			self.lost += (next_seq - self.next_seq) & 0xFFFF
+			self.next_seq = next_seq
+		return res
+
+
+class RtpStreamQuery(Query):
+	type = 'api.rtp'
+	priority: int
+	force: bool
+	stack: AudioStack
+	recording: Optional[Recording] = None
+
+	def __init__(self, icom: Icom, name: str, priority: int = 0, force: bool = False, author: Optional[QueryAuthor] = None):
+		self.description = f"Playing RTP stream '{name}'"
+		self.priority = priority
+		self.force = force
+		self.author = author
+
+		rate = icom.output.rate
+		self.stack = AudioStack(
+			rate=rate,
+			channels=1,
+			samples=max(1, int(rate * RTP_STACK_SECONDS))
+		)
+
+		super().__init__(icom)
+
+	def push(self, audio: Audio):
+		self.stack.push(StreamData(audio))
+		if self.recording:
+			self.recording.write(audio.data)
+
+	def _pull(self, options: StreamOptions) -> StreamData:
+		if self.status != QueryStatus.PLAYING:
+			return StreamData(None, last=True)
+		return self.stack.pull(options)
+
+	def play(self, options: PlayOptions):
+		super().play(options)
+		options.mixer.add(self._pull)
+
+	def end(self):
+		if self.recording:
+			self.recording.close()
+		match self.status:
+			case QueryStatus.PLAYING:
+				self.finish()
+			case QueryStatus.WAITING:
+				self.cancel()
+
+
+class RtpIngestProtocol(asyncio.DatagramProtocol):
+	def __init__(self, ingest: 'RtpIngest'):
+		self.ingest = ingest
+
+	def datagram_received(self, data: bytes, addr):
+		self.ingest.receive(data)
+
+	def error_received(self, exc: Exception):
+		logger.warning(f"RTP endpoint '{self.ingest.name}' socket error: {exc}")
+
+
+class RtpIngest:
+	'''Receives RTP audio on a UDP port and plays every talk spurt as a query'''
+	name: str
+	config: RtpEndpointConfig
+	icom: Icom
+	author: Optional[QueryAuthor]
+	# Close the endpoint after the first talk spurt
+	oneshot: bool
+	query: Optional[RtpStreamQuery] = None
+	transport: Optional[asyncio.DatagramTransport] = None
+	closed: bool = False
+
+	def __init__(self, name: str, config: RtpEndpointConfig, icom: Icom, author: Optional[QueryAuthor] = None, oneshot: bool = False):
+		self.name = name
+		self.config = config
+		self.icom = icom
+		self.author = author
+		self.oneshot = oneshot
+		self.rate = config.rate or _CODEC_RATES.get(config.codec, 8000)
+		self.reorder = RtpReorderBuffer(config.reorder_depth)
+		self.packets = 0
+		self._ssrc: Optional[int] = None
+		self._last_packet = time.monotonic()
+		self._muted = False
+		self._resampler: Optional[LinearResampler] = None
+		self._opus: Optional[OggOpusWriter] = None
+		self._opus_decoder: Optional[FFmpegStreamDecoder] = None
+		self._opus_ts: int = 0
+		self._idle_task: Optional[asyncio.Task] = None
+
+	@property
+	def port(self) -> Optional[int]:
+		if self.transport is None:
+			return None
+		return self.transport.get_extra_info('sockname')[1]
+
+	async def start(self):
+		loop = asyncio.get_running_loop()
+		self.transport, _ = await loop.create_datagram_endpoint(
+			lambda: RtpIngestProtocol(self),
+			local_addr=(self.config.host, self.config.port)
+		)
+		self._idle_task = asyncio.create_task(self._watch_idle())
+		logger.info(f"RTP endpoint '{self.name}' listening on port {self.port} ({self.config.codec})")
+
+	async def close(self):
+		if self.closed:
+			return
+		self.closed = True
+		if self._idle_task is not None and self._idle_task is not asyncio.current_task():
+			self._idle_task.cancel()
+		if self.transport is not None:
+			self.transport.close()
+		await self._end_spurt()
+		_sessions.pop(self.name, None)
+		logger.info(f"RTP endpoint '{self.name}' closed")
+
+	def receive(self, data: bytes):
+		packet = parse_rtp_packet(data)
+		if packet is None or self.closed:
+			return
+		self.packets += 1
+		self._last_packet = time.monotonic()
+		if self._muted:
+			return
+
+		if packet.ssrc != self._ssrc:
+			# New sender or restarted stream, sequence and timestamps start over
+			self._ssrc = packet.ssrc
+			self.reorder.reset()
+
+		if self.query is None:
+			self._begin_spurt(packet.timestamp)
+
+		for packet in self.reorder.push(packet):
+			try:
+				self._decode(packet)
+			except Exception as e:
+				logger.warning(f"RTP endpoint '{self.name}' failed to decode packet: {e}")
+
+	def _begin_spurt(self, timestamp: int):
+		icom = self.icom
+		self.query = RtpStreamQuery(
+			icom=icom,
+			name=self.name,
+			priority=self.config.priority,
+			force=self.config.force,
+			author=self.author
+		)
+		icom_rate = icom.output.rate
+		self.query.recording = start_recording(self.query, icom_rate, 1)
+		if self.config.codec == 'opus':
+			# Every spurt is a fresh Ogg stream, its granules count from the first packet
+			self._opus_ts = timestamp
+			self._opus = OggOpusWriter(serial=self._ssrc or 0)
+			aio.run(self._start_opus_decoder(self.query, icom_rate))
+		elif self.rate != icom_rate:
+			self._resampler = LinearResampler(self.rate, icom_rate)
+
+	async def _start_opus_decoder(self, query: RtpStreamQuery, rate: int):
+		try:
+			decoder = await FFmpegStreamDecoder.create(
+				container='ogg',
+				rate=rate,
+				channels=1,
+				on_audio=query.push,
+				low_latency=True,
+			)
+		except Exception as e:
+			logger.error(f"RTP endpoint '{self.name}' failed to start opus decoder", exc_info=e)
+			if query is self.query:
+				# Ignore the sender until it goes quiet instead of retrying on every packet
+				self._muted = True
+				await self._end_spurt()
+			return
+		if query is not self.query:
+			await decoder.close()
+			return
+		self._opus_decoder = decoder
+
+	async def _end_spurt(self):
+		query = self.query
+		self.query = None
+		self._resampler = None
+		self._opus = None
+		decoder = self._opus_decoder
+		self._opus_decoder = None
+		self.reorder.reset()
+		if query is not None:
+			query.end()
+		if decoder is not None:
+			try: await decoder.close()
+			except Exception: pass
+
+	def _decode(self, packet: RtpPacket):
+		match self.config.codec:
+			case 'pcmu':
+				data = decode_ulaw(packet.payload)
+			case 'pcma':
+				data = decode_alaw(packet.payload)
+			case 'l16':
+				data = decode_l16(packet.payload)
+			case 'opus':
+				self._decode_opus(packet)
+				return
+		if self._resampler is not None:
+			data = self._resampler.process(data)
+		if data.size:
+			self.query.push(Audio(data.reshape((-1, 1)), self.icom.output.rate))
+
+	def _decode_opus(self, packet: RtpPacket):
+		decoder = self._opus_decoder
+		writer = self._opus
+		if decoder is None or writer is None:
+			# Decoder is still starting, packets of the first few ms are dropped
+			return
+		# The granule of a page is the end of its audio (RFC 7845), RTP timestamps mark the start
+		granule = ((packet.timestamp - self._opus_ts) & 0xFFFFFFFF) + opus_packet_samples(packet.payload)
+		decoder.feed(writer.write(packet.payload, granule))
+
+	async def _watch_idle(self):
+		timeout = self.config.idle_timeout
+		while True:
+			await asyncio.sleep(RTP_IDLE_CHECK_INTERVAL)
+			query = self.query
+			if query is not None and query.status not in (QueryStatus.WAITING, QueryStatus.PLAYING):
+				# Query was cancelled from outside, ignore the sender until it goes quiet
+				self._muted = True
+				await self._end_spurt()
+			if time.monotonic() - self._last_packet < timeout:
+				continue
+			self._muted = False
+			if self.query is not None:
+				await self._end_spurt()
+			if self.oneshot:
+				await self.close()
+				return
+
+
+_sessions: dict[str, RtpIngest] = dict()
+
+
+class APIRtpSessionRequest(BaseModel):
+	icom: str
+	codec: RtpCodec = 'pcmu'
+	rate: Optional[int] = Field(default=None, gt=0)
+	priority: int = 0
+	force: bool = False
+	port: int = Field(default=0, ge=0, le=65535)
+	# Seconds to wait for the first packet and for silence after the stream
+	idle_timeout: float = Field(default=5.0, gt=0)
+
+class RtpSessionInfo(BaseModel):
+	name: str
+	icom: str
+	port: int
+	codec: RtpCodec
+	packets: int
+	lost: int
+	late: int
+
+def _session_info(ingest: RtpIngest) -> RtpSessionInfo:
+	return RtpSessionInfo(
+		name=ingest.name,
+		icom=ingest.icom.id,
+		port=ingest.port or 0,
+		codec=ingest.config.codec,
+		packets=ingest.packets,
+		lost=ingest.reorder.lost,
+		late=ingest.reorder.late
+	)
+
+
+@api.get('/queries/rtp', tags=['queries'], dependencies=[
+	Depends(require_permissions('bmaster.icoms.queries.rtp'))
+])
+async def get_rtp_sessions() -> list[RtpSessionInfo]:
+	return [_session_info(ingest) for ingest in _sessions.values()]
+
+@api.post('/queries/rtp', tags=['queries'], dependencies=[
+	Depends(require_permissions('bmaster.icoms.queries.rtp'))
+])
+async def open_rtp_session(user: Annotated[User, Depends(require_user)], request: APIRtpSessionRequest) -> RtpSessionInfo:
+	icom = icoms.get(request.icom)
+	if not icom:
+		raise HTTPException(status.HTTP_404_NOT_FOUND, 'Icom not found')
+	if request.codec == 'opus' and not shutil.which('ffmpeg'):
+		raise HTTPException(status.HTTP_501_NOT_IMPLEMENTED, 'ffmpeg is required for opus decoding but is not installed')
+
+	endpoint_config = RtpEndpointConfig(
+		icom=request.icom,
+		port=request.port,
+		codec=request.codec,
+		rate=request.rate,
+		priority=request.priority,
+		force=request.force,
+		idle_timeout=request.idle_timeout
+	)
+	ingest = RtpIngest(
+		name=f'session-{uuid.uuid4().hex[:8]}',
+		config=endpoint_config,
+		icom=icom,
+		author=query_author_from_user(user),
+		oneshot=True
+	)
+	try:
+		await ingest.start()
+	except OSError as e:
+		raise HTTPException(status.HTTP_409_CONFLICT, f'Could not open RTP port: {e}')
+	_sessions[ingest.name] = ingest
+	return _session_info(ingest)
+
+
+async def start():
+	global config
+
+	config = RtpConfig.model_validate(configs.get('rtp', None) or {})
+
+	for name, endpoint_config in config.endpoints.items():
+		icom = icoms.get(endpoint_config.icom)
+		if not icom:
+			logger.error(f"RTP endpoint '{name}' refers to unknown icom '{endpoint_config.icom}'")
+			continue
+		if endpoint_config.codec == 'opus' and not shutil.which('ffmpeg'):
+			logger.error(f"RTP endpoint '{name}' needs ffmpeg for opus decoding but it is not installed")
+			continue
+		ingest = RtpIngest(name, endpoint_config, icom, author=QueryAuthor(type='rtp', name=name))
+		try:
+			await ingest.start()
+		except OSError as e:
+			logger.error(f"Failed to open RTP endpoint '{name}'", exc_info=e)
+			continue
+		_sessions[name] = ingest
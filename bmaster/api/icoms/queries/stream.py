@@ -1,21 +1,26 @@
 import asyncio
 import json
+import secrets
 import shutil
+import time
 from dataclasses import dataclass
 from typing import Callable, Literal, Optional
 
 import numpy as np
-from fastapi import HTTPException, WebSocket, WebSocketDisconnect, status
+from fastapi import Depends, WebSocket, WebSocketDisconnect
 from pydantic import BaseModel, Field, ValidationError
-from wauxio import Audio, StreamData
+from wauxio import Audio, StreamData, StreamOptions
 from wauxio.utils import AudioStack
+from wsignals import Signal
 
 from bmaster.api import api
-from bmaster.api.auth import require_auth_token, require_bearer_jwt, require_permissions, require_user
+from bmaster.api.auth import require_permissions, require_ws_user
 from bmaster.api.auth.users import User
 from bmaster.api.icoms.queries import query_author_from_user
 from bmaster.icoms import Icom
 from bmaster.icoms.queries import PlayOptions, Query, QueryStatus
+from bmaster.recording import Recording, start_recording
+from bmaster.utils.audio import SilenceDetector
 import bmaster.icoms as icoms
 
 # Frontend commonly sends chunks around 16k samples (~0.34s @48kHz).
@@ -23,6 +28,19 @@ import bmaster.icoms as icoms
 STREAM_STACK_SECONDS = 0.6
 DEFAULT_STREAM_RATE = 48_000
 
+# Flow control (opt-in per stream): the client may send only up to the byte
+# limit granted by the server. Credit is withheld while the playback buffer
+# is above the high watermark, so an overloaded decoder slows the client down
+# instead of queueing frames inside the server.
+STREAM_CREDIT_BYTES = 32 * 1024
+STREAM_BUFFER_HIGH_SECONDS = 0.4
+STREAM_CONTROL_INTERVAL = 0.1
+STREAM_BUFFER_REPORT_INTERVAL = 0.5
+# How long a dropped stream keeps its query and decoder for a reconnecting client
+STREAM_RESUME_GRACE_SECONDS = 5.0
+# Telemetry window, also the period of 'stats' messages for clients asking for them
+STREAM_STATS_INTERVAL = 1.0
+
 
 class StartMessageValidationError(Exception):
 	def __init__(self, error: str, validation_errors: Optional[list[dict]] = None):
@@ -42,6 +60,9 @@ class APIStreamStartRequest(BaseModel):
 	timeslice_ms: Optional[int] = Field(default=None, gt=0)
 	sample_rate_hint: Optional[int] = Field(default=None, gt=0)
 	channels_hint: Optional[int] = Field(default=None, gt=0)
+	flow_control: bool = False
+	stats: bool = False
+	resume: Optional[str] = None
 
 
 @dataclass(frozen=True)
@@ -52,6 +73,66 @@ class NormalizedStreamStart:
 	rate: int
 	channels: int
 	container: str
+	flow_control: bool = False
+	stats: bool = False
+	resume: Optional[str] = None
+
+
+class StreamStatsInfo(BaseModel):
+	query: str
+	icom: str
+	status: QueryStatus
+	connected: bool
+	uptime: float
+	reconnects: int
+	bytes_received: int
+	messages_received: int
+	samples_decoded: int
+	samples_played: int
+	decoder_latency_ms: Optional[float]
+	decoder_latency_avg_ms: Optional[float]
+	decoder_latency_max_ms: Optional[float]
+	buffered_ms: float
+	buffered_min_ms: Optional[float]
+	buffered_avg_ms: Optional[float]
+	buffered_max_ms: Optional[float]
+	underruns: int
+	overflow_samples: int
+	credit_limit: Optional[int] = None
+
+
+class StreamStats:
+	'''Playback counters of a stream query, buffer fill level is tracked per telemetry window'''
+	samples_decoded: int = 0
+	samples_played: int = 0
+	# Mixer ticks that found less audio in the stack than they needed
+	underruns: int = 0
+	# Decoded samples that did not fit into the stack
+	overflow_samples: int = 0
+
+	def __init__(self):
+		self.started_at = time.monotonic()
+		self.reset_window()
+
+	def reset_window(self):
+		self.fill_min: Optional[int] = None
+		self.fill_max: Optional[int] = None
+		self._fill_sum = 0
+		self._fill_count = 0
+
+	def sample_fill(self, buffered: int):
+		if self.fill_min is None or buffered < self.fill_min:
+			self.fill_min = buffered
+		if self.fill_max is None or buffered > self.fill_max:
+			self.fill_max = buffered
+		self._fill_sum += buffered
+		self._fill_count += 1
+
+	@property
+	def fill_avg(self) -> Optional[float]:
+		if not self._fill_count:
+			return None
+		return self._fill_sum / self._fill_count
 
 
 class APIStreamQuery(Query):
@@ -59,6 +140,15 @@ class APIStreamQuery(Query):
 	priority: int
 	force: bool
 	stack: AudioStack
+	rate: int
+	capacity: int
+	# Estimated number of samples waiting in the stack
+	buffered: int = 0
+	recording: Optional[Recording] = None
+	stats: StreamStats
+	silence: Optional[SilenceDetector] = None
+	# Called once when the stream has been silent for icoms.silence.stream_timeout while playing
+	on_silence: Signal
 
 	def __init__(self, icom: Icom, priority: int, force: bool, rate: int, channels: int, author: Optional[User] = None):
 		self.description = 'Playing plain audio stream'
@@ -66,18 +156,60 @@ class APIStreamQuery(Query):
 		self.force = force
 		self.author = query_author_from_user(author) if author else None
 
+		self.rate = rate
+		self.stats = StreamStats()
+		self.capacity = max(1, int(rate * STREAM_STACK_SECONDS))
 		self.stack = AudioStack(
 			rate=rate,
 			channels=channels,
-			samples=max(1, int(rate * STREAM_STACK_SECONDS))
+			samples=self.capacity
 		)
+		self.on_silence = Signal()
+		silence_config = icoms.config.silence
+		if silence_config.stream_timeout:
+			self.silence = SilenceDetector(rate, silence_config.threshold_db, silence_config.hysteresis_db)
 
 		super().__init__(icom)
 
+	@property
+	def buffered_seconds(self) -> float:
+		return self.buffered / self.rate
+
+	def push(self, audio: Audio):
+		samples = len(audio.data)
+		stats = self.stats
+		stats.samples_decoded += samples
+		overflow = self.buffered + samples - self.capacity
+		if overflow > 0:
+			stats.overflow_samples += overflow
+		self.buffered = min(self.capacity, self.buffered + samples)
+		self.stack.push(StreamData(audio))
+		if self.recording:
+			self.recording.write(audio.data)
+
+		silence = self.silence
+		if silence is not None and self.status == QueryStatus.PLAYING:
+			if silence.update(audio.data) >= icoms.config.silence.stream_timeout:
+				self.silence = None
+				self.on_silence.call()
+
+	def _pull(self, options: StreamOptions) -> StreamData:
+		frame = self.stack.pull(options)
+		audio = frame.audio
+		if audio:
+			stats = self.stats
+			samples = len(audio.data)
+			stats.sample_fill(self.buffered)
+			if self.buffered < samples:
+				stats.underruns += 1
+			stats.samples_played += min(self.buffered, samples)
+			self.buffered = max(0, self.buffered - samples)
+		return frame
+
 	def play(self, options: PlayOptions):
 		super().play(options)
 		mixer = options.mixer
-		mixer.add(self.stack.pull)
+		mixer.add(self._pull)
 
 	def stop(self):
 		super().stop()
@@ -95,16 +227,28 @@ class FFmpegStreamDecoder:
 		self._stdout_task: Optional[asyncio.Task] = None
 		self._stderr_task: Optional[asyncio.Task] = None
 		self._closed = False
+		self.bytes_in = 0
+		# Time from the first byte written into an idle decoder to its first decoded samples
+		self.latency: Optional[float] = None
+		self.latency_max: Optional[float] = None
+		self._latency_sum = 0.0
+		self._latency_count = 0
+		self._pending_since: Optional[float] = None
 
 	@classmethod
-	async def create(cls, container: str, rate: int, channels: int, on_audio: Callable[[Audio], None]) -> 'FFmpegStreamDecoder':
+	async def create(cls, container: str, rate: int, channels: int, on_audio: Callable[[Audio], None], low_latency: bool = False) -> 'FFmpegStreamDecoder':
 		command = [
 			'ffmpeg',
 			'-hide_banner',
 			'-loglevel',
 			'error',
 			'-fflags',
-			'+discardcorrupt',
+			'+discardcorrupt+nobuffer' if low_latency else '+discardcorrupt',
+		]
+		if low_latency:
+			# Skip input probing, the container is known upfront
+			command += ['-probesize', '32', '-analyzeduration', '0']
+		command += [
 			'-f',
 			container,
 			'-i',
@@ -114,6 +258,10 @@ class FFmpegStreamDecoder:
 			str(channels),
 			'-ar',
 			str(rate),
+		]
+		if low_latency:
+			command += ['-flush_packets', '1']
+		command += [
 			'-f',
 			'f32le',
 			'pipe:1',
@@ -143,6 +291,30 @@ class FFmpegStreamDecoder:
 			return
 		arr = arr.reshape((-1, self.channels))
 		self._on_audio(Audio(arr.copy(), self.rate))
+		self._mark_output()
+
+	def _mark_input(self, size: int):
+		self.bytes_in += size
+		if self._pending_since is None:
+			self._pending_since = time.monotonic()
+
+	def _mark_output(self):
+		pending_since = self._pending_since
+		if pending_since is None:
+			return
+		self._pending_since = None
+		latency = time.monotonic() - pending_since
+		self.latency = latency
+		if self.latency_max is None or latency > self.latency_max:
+			self.latency_max = latency
+		self._latency_sum += latency
+		self._latency_count += 1
+
+	@property
+	def latency_avg(self) -> Optional[float]:
+		if not self._latency_count:
+			return None
+		return self._latency_sum / self._latency_count
 
 	async def _read_stdout(self):
 		try:
@@ -178,6 +350,7 @@ class FFmpegStreamDecoder:
 			return
 		self._raise_if_broken()
 		assert self.process.stdin is not None
+		self._mark_input(len(data))
 		try:
 			self.process.stdin.write(data)
 			await self.process.stdin.drain()
@@ -185,6 +358,17 @@ class FFmpegStreamDecoder:
 			raise RuntimeError('ffmpeg decoder pipe closed') from e
 		self._raise_if_broken()
 
+	def feed(self, data: bytes):
+		'''Writes bytes without waiting for the pipe to drain, for sources that can not be slowed down'''
+		if not data:
+			return
+		self._raise_if_broken()
+		assert self.process.stdin is not None
+		if self.process.stdin.is_closing():
+			raise RuntimeError('ffmpeg decoder pipe closed')
+		self._mark_input(len(data))
+		self.process.stdin.write(data)
+
 	async def close(self):
 		if self._closed:
 			return
@@ -211,6 +395,249 @@ class FFmpegStreamDecoder:
 		self._buffer.clear()
 
 
+class StreamFlowControl:
+	'''Cumulative byte credit granted to a flow controlled stream client'''
+	window: int
+	# Total amount of bytes the client is allowed to send
+	limit: int = 0
+	received: int = 0
+
+	def __init__(self, window: int):
+		self.window = window
+
+	@property
+	def outstanding(self) -> int:
+		return self.limit - self.received
+
+	def consume(self, size: int) -> bool:
+		self.received += size
+		return self.received <= self.limit
+
+	def replenish(self, buffered_seconds: float) -> bool:
+		'''Extends the limit if the client is running out of credit and the playback buffer has room'''
+		if buffered_seconds >= STREAM_BUFFER_HIGH_SECONDS:
+			return False
+		if self.outstanding > self.window // 2:
+			return False
+		self.limit = self.received + self.window
+		return True
+
+
+class StreamSession:
+	'''Stream query with its decoder, kept alive for a grace period after the websocket drops'''
+	token: str
+	owner: str
+	query: APIStreamQuery
+	decoder: Optional[FFmpegStreamDecoder] = None
+	flow: Optional[StreamFlowControl] = None
+	ws: Optional[WebSocket] = None
+	closed: bool = False
+	# Send periodic 'stats' messages to the client
+	send_stats: bool = False
+	messages_received: int = 0
+	reconnects: int = 0
+	last_stats: Optional[StreamStatsInfo] = None
+
+	def __init__(self, query: APIStreamQuery, owner: str, flow_control: bool = False, send_stats: bool = False):
+		self.token = secrets.token_urlsafe(16)
+		self.owner = owner
+		self.query = query
+		self.send_stats = send_stats
+		if flow_control:
+			self.flow = StreamFlowControl(STREAM_CREDIT_BYTES)
+		self._flow_task: Optional[asyncio.Task] = None
+		self._expire_task: Optional[asyncio.Task] = None
+		self._stats_task: Optional[asyncio.Task] = None
+
+		@query.on_cancel
+		async def on_cancel():
+			await self.send_json({
+				'type': 'cancelled',
+				'query': query.get_info().model_dump(mode='json'),
+			})
+			ws = self.ws
+			if ws is None:
+				await self.close()
+				return
+			try: await ws.close()
+			except (WebSocketDisconnect, RuntimeError): pass
+
+		@query.on_stop
+		async def on_stop():
+			await self.send_json({
+				'type': 'stopped',
+				'query': query.get_info().model_dump(mode='json'),
+			})
+
+		@query.on_silence
+		async def on_silence():
+			await self.send_json({
+				'type': 'silence',
+				'query': query.get_info().model_dump(mode='json'),
+			})
+			await self.close()
+
+		@query.on_play
+		async def on_play():
+			await self.send_json({
+				'type': 'started',
+				'query': query.get_info().model_dump(mode='json'),
+			})
+
+		_stream_sessions[self.token] = self
+
+	@property
+	def active(self) -> bool:
+		return not self.closed and self.query.status in (QueryStatus.WAITING, QueryStatus.PLAYING)
+
+	async def send_json(self, data: dict):
+		ws = self.ws
+		if ws is None:
+			return
+		try:
+			await ws.send_json(data)
+		except (WebSocketDisconnect, RuntimeError):
+			pass
+
+	async def send_credit(self):
+		await self.send_json({
+			'type': 'credit',
+			'limit': self.flow.limit,
+			'received': self.flow.received,
+			'buffered_ms': round(self.query.buffered_seconds * 1000),
+		})
+
+	def get_stats(self) -> StreamStatsInfo:
+		q = self.query
+		stats = q.stats
+		decoder = self.decoder
+
+		def _ms(value: Optional[float], scale: float = 1000) -> Optional[float]:
+			return round(value * scale, 1) if value is not None else None
+
+		sample_ms = 1000 / q.rate
+		return StreamStatsInfo(
+			query=str(q.id),
+			icom=q.icom.id,
+			status=q.status,
+			connected=self.ws is not None,
+			uptime=round(time.monotonic() - stats.started_at, 1),
+			reconnects=self.reconnects,
+			bytes_received=decoder.bytes_in if decoder else 0,
+			messages_received=self.messages_received,
+			samples_decoded=stats.samples_decoded,
+			samples_played=stats.samples_played,
+			decoder_latency_ms=_ms(decoder.latency) if decoder else None,
+			decoder_latency_avg_ms=_ms(decoder.latency_avg) if decoder else None,
+			decoder_latency_max_ms=_ms(decoder.latency_max) if decoder else None,
+			buffered_ms=round(q.buffered * sample_ms, 1),
+			buffered_min_ms=_ms(stats.fill_min, sample_ms),
+			buffered_avg_ms=_ms(stats.fill_avg, sample_ms),
+			buffered_max_ms=_ms(stats.fill_max, sample_ms),
+			underruns=stats.underruns,
+			overflow_samples=stats.overflow_samples,
+			credit_limit=self.flow.limit if self.flow else None,
+		)
+
+	async def attach(self, ws: WebSocket):
+		if self._expire_task is not None:
+			self._expire_task.cancel()
+			self._expire_task = None
+			self.reconnects += 1
+		# After a short network drop the old socket is usually still open until the ping timeout
+		stale = self.ws
+		if stale is not None:
+			self.reconnects += 1
+			if self._flow_task is not None:
+				self._flow_task.cancel()
+				self._flow_task = None
+		self.ws = ws
+		if stale is not None:
+			try: await stale.close()
+			except (WebSocketDisconnect, RuntimeError): pass
+		if self._stats_task is None:
+			self._stats_task = asyncio.create_task(self._run_stats())
+
+		flow = self.flow
+		if flow:
+			# Bytes sent before the drop may have been lost in transit
+			flow.limit = flow.received
+			flow.replenish(self.query.buffered_seconds)
+			await self.send_credit()
+			self._flow_task = asyncio.create_task(self._run_flow_control())
+
+	async def detach(self, ws: WebSocket):
+		'''Releases the websocket, keeping the query and decoder for a reconnect'''
+		# Already taken over by a resumed connection
+		if self.ws is not ws:
+			return
+		self.ws = None
+		if self._flow_task is not None:
+			self._flow_task.cancel()
+			self._flow_task = None
+		if not self.active:
+			await self.close()
+			return
+		self._expire_task = asyncio.create_task(self._expire())
+
+	async def close(self):
+		if self.closed:
+			return
+		self.closed = True
+		_stream_sessions.pop(self.token, None)
+
+		current = asyncio.current_task()
+		for task in (self._flow_task, self._expire_task, self._stats_task):
+			if task is not None and task is not current:
+				task.cancel()
+
+		if self.decoder is not None:
+			try:
+				await self.decoder.close()
+			except Exception:
+				pass
+
+		q = self.query
+		if q.recording:
+			q.recording.close()
+		if q.status in (QueryStatus.WAITING, QueryStatus.PLAYING):
+			q.cancel()
+
+	async def _expire(self):
+		await asyncio.sleep(STREAM_RESUME_GRACE_SECONDS)
+		await self.close()
+
+	async def _run_flow_control(self):
+		flow = self.flow
+		q = self.query
+		report_every = max(1, round(STREAM_BUFFER_REPORT_INTERVAL / STREAM_CONTROL_INTERVAL))
+		tick = 0
+		while True:
+			await asyncio.sleep(STREAM_CONTROL_INTERVAL)
+			tick += 1
+			if flow.replenish(q.buffered_seconds):
+				await self.send_credit()
+			elif tick % report_every == 0:
+				await self.send_json({
+					'type': 'buffer',
+					'buffered_ms': round(q.buffered_seconds * 1000),
+				})
+
+	async def _run_stats(self):
+		while True:
+			await asyncio.sleep(STREAM_STATS_INTERVAL)
+			info = self.get_stats()
+			self.last_stats = info
+			self.query.stats.reset_window()
+			if self.send_stats:
+				await self.send_json({
+					'type': 'stats',
+					**info.model_dump(mode='json'),
+				})
+
+_stream_sessions: dict[str, StreamSession] = dict()
+
+
 def _is_supported_opus_format(codec: str, container: str, mime_type: str) -> bool:
 	codec = codec.strip().lower()
 	container = container.strip().lower()
@@ -239,6 +666,9 @@ def _parse_start_message(raw_text: str) -> NormalizedStreamStart:
 		rate=start.sample_rate_hint or DEFAULT_STREAM_RATE,
 		channels=start.channels_hint or 1,
 		container=start.container.strip().lower(),
+		flow_control=start.flow_control,
+		stats=start.stats,
+		resume=start.resume,
 	)
 
 
@@ -250,51 +680,163 @@ def _is_stop_message(raw_text: str) -> bool:
 	return isinstance(data, dict) and data.get('type') == 'stop'
 
 
-def _get_ws_bearer_token(ws: WebSocket) -> Optional[str]:
-	auth_header = ws.headers.get('authorization')
-	if auth_header:
-		scheme, _, token = auth_header.partition(' ')
-		if scheme.lower() == 'bearer' and token:
-			return token
-		if scheme and not token:
-			# Allow raw token in header for non-standard clients.
-			return scheme
-	return ws.query_params.get('token')
+async def _require_stream_user(ws: WebSocket) -> Optional[User]:
+	return await require_ws_user(ws, 'bmaster.icoms.queries.stream')
 
 
-async def _require_stream_user(ws: WebSocket) -> Optional[User]:
-	token = _get_ws_bearer_token(ws)
-	if not token:
+async def _send_validation_error(ws: WebSocket, error: StartMessageValidationError):
+	payload = {
+		'type': 'error',
+		'error': error.error,
+	}
+	if error.validation_errors:
+		payload['validation.errors'] = error.validation_errors
+	await ws.send_json(payload)
+
+
+async def _resume_session(ws: WebSocket, user: User, token: str) -> Optional[StreamSession]:
+	session = _stream_sessions.get(token)
+	if not session or not session.active or session.owner != user.get_label():
 		await ws.send_json({
 			'type': 'error',
-			'error': 'missing bearer token',
+			'error': 'stream session not found',
 		})
-		await ws.close(code=status.WS_1008_POLICY_VIOLATION)
+		await ws.close()
 		return None
 
-	try:
-		jwt_data = require_bearer_jwt(token)
-		auth_token = require_auth_token(jwt_data)
-		user = await require_user(auth_token)
-		require_permissions('bmaster.icoms.queries.stream')(user)
-		return user
-	except HTTPException as e:
+	await ws.send_json({
+		'type': 'resumed',
+		'resume_token': session.token,
+		'query': session.query.get_info().model_dump(mode='json'),
+	})
+	await session.attach(ws)
+	return session
+
+
+async def _create_session(ws: WebSocket, user: User, start: NormalizedStreamStart) -> Optional[StreamSession]:
+	icom = icoms.get(start.icom)
+	if not icom:
 		await ws.send_json({
 			'type': 'error',
-			'error': e.detail,
+			'error': 'icom not found',
 		})
-		await ws.close(code=status.WS_1008_POLICY_VIOLATION)
+		await ws.close()
 		return None
 
+	channels = start.channels
+	# TODO: Implement multi-channel support.
+	if channels != 1:
+		await ws.send_json({
+			'type': 'error',
+			'error': 'only 1 channel supported',
+		})
+		await ws.close()
+		return None
 
-async def _send_validation_error(ws: WebSocket, error: StartMessageValidationError):
-	payload = {
-		'type': 'error',
-		'error': error.error,
-	}
-	if error.validation_errors:
-		payload['validation.errors'] = error.validation_errors
-	await ws.send_json(payload)
+	rate = start.rate
+
+	if not shutil.which('ffmpeg'):
+		await ws.send_json({
+			'type': 'error',
+			'error': 'ffmpeg is required for opus stream decoding but is not installed',
+		})
+		await ws.close()
+		return None
+
+	q = APIStreamQuery(
+		icom=icom,
+		priority=start.priority,
+		force=start.force,
+		rate=rate,
+		channels=channels,
+		author=user,
+	)
+	q.recording = start_recording(q, rate, channels)
+	session = StreamSession(q, owner=user.get_label(), flow_control=start.flow_control, send_stats=start.stats)
+
+	try:
+		await ws.send_json({
+			'type': 'waiting' if q.status == QueryStatus.WAITING else 'started',
+			'resume_token': session.token,
+			'query': q.get_info().model_dump(mode='json'),
+		})
+		await session.attach(ws)
+		session.decoder = await FFmpegStreamDecoder.create(
+			container=start.container,
+			rate=rate,
+			channels=channels,
+			on_audio=q.push,
+		)
+	except BaseException:
+		await session.close()
+		raise
+
+	return session
+
+
+async def _receive_stream(ws: WebSocket, session: StreamSession) -> bool:
+	'''Feeds websocket audio into the session decoder.
+
+	Returns True if the stream ended on purpose and False if the connection dropped.'''
+	flow = session.flow
+	decoder = session.decoder
+	assert decoder is not None
+
+	while True:
+		try:
+			message = await ws.receive()
+		except WebSocketDisconnect:
+			return False
+
+		message_type = message.get('type')
+		if message_type == 'websocket.disconnect':
+			return False
+		if message_type != 'websocket.receive':
+			continue
+
+		binary_data = message.get('bytes')
+		if binary_data is not None:
+			session.messages_received += 1
+			if flow and not flow.consume(len(binary_data)):
+				await ws.send_json({
+					'type': 'error',
+					'error': 'flow control credit exceeded',
+				})
+				await ws.close()
+				return True
+			try:
+				await decoder.push_bytes(binary_data)
+			except Exception as e:
+				await ws.send_json({
+					'type': 'error',
+					'error': f'audio decode failed: {e}',
+				})
+				await ws.close()
+				return True
+			if flow and flow.replenish(session.query.buffered_seconds):
+				await session.send_credit()
+			continue
+
+		text_data = message.get('text')
+		if text_data is not None:
+			if _is_stop_message(text_data):
+				return True
+			await ws.send_json({
+				'type': 'error',
+				'error': 'invalid control message, expected {"type":"stop"}',
+			})
+			await ws.close()
+			return True
+
+
+@api.get('/queries/stream/stats', tags=['queries'], dependencies=[
+	Depends(require_permissions('bmaster.icoms.read'))
+])
+async def get_stream_stats() -> list[StreamStatsInfo]:
+	return [
+		session.last_stats or session.get_stats()
+		for session in _stream_sessions.values()
+	]
 
 
 @api.websocket('/queries/stream')
@@ -308,9 +850,8 @@ async def play_stream(ws: WebSocket):
 	if not user:
 		return
 
-	start: Optional[NormalizedStreamStart] = None
-	q: Optional[APIStreamQuery] = None
-	decoder: Optional[FFmpegStreamDecoder] = None
+	session: Optional[StreamSession] = None
+	finished = True
 
 	try:
 		try:
@@ -337,141 +878,20 @@ async def play_stream(ws: WebSocket):
 			await ws.close()
 			return
 
-		icom = icoms.get(start.icom)
-		if not icom:
-			await ws.send_json({
-				'type': 'error',
-				'error': 'icom not found',
-			})
-			await ws.close()
-			return
-
-		channels = start.channels
-		# TODO: Implement multi-channel support.
-		if channels != 1:
-			await ws.send_json({
-				'type': 'error',
-				'error': 'only 1 channel supported',
-			})
-			await ws.close()
-			return
-
-		rate = start.rate
-
-		if not shutil.which('ffmpeg'):
-			await ws.send_json({
-				'type': 'error',
-				'error': 'ffmpeg is required for opus stream decoding but is not installed',
-			})
-			await ws.close()
-			return
-
-		q = APIStreamQuery(
-			icom=icom,
-			priority=start.priority,
-			force=start.force,
-			rate=rate,
-			channels=channels,
-			author=user,
-		)
-
-		try:
-			await ws.send_json({
-				'type': 'waiting' if q.status == QueryStatus.WAITING else 'started',
-				'query': q.get_info().model_dump(mode='json'),
-			})
-		except WebSocketDisconnect:
-			q.cancel()
+		if start.resume:
+			session = await _resume_session(ws, user, start.resume)
+		else:
+			session = await _create_session(ws, user, start)
+		if not session:
 			return
 
-		@q.on_cancel
-		async def on_cancel():
-			try:
-				await ws.send_json({
-					'type': 'cancelled',
-					'query': q.get_info().model_dump(mode='json'),
-				})
-				await ws.close()
-			except WebSocketDisconnect:
-				pass
-			except RuntimeError:
-				pass
-
-		@q.on_stop
-		async def on_stop():
-			try:
-				await ws.send_json({
-					'type': 'stopped',
-					'query': q.get_info().model_dump(mode='json'),
-				})
-			except WebSocketDisconnect:
-				pass
-			except RuntimeError:
-				pass
-
-		@q.on_play
-		async def on_play():
-			try:
-				await ws.send_json({
-					'type': 'started',
-					'query': q.get_info().model_dump(mode='json'),
-				})
-			except WebSocketDisconnect:
-				pass
-
-		def _push_audio(audio: Audio):
-			assert q is not None
-			q.stack.push(StreamData(audio))
-
-		decoder = await FFmpegStreamDecoder.create(
-			container=start.container,
-			rate=rate,
-			channels=channels,
-			on_audio=_push_audio,
-		)
-
-		while True:
-			try:
-				message = await ws.receive()
-			except WebSocketDisconnect:
-				break
-
-			message_type = message.get('type')
-			if message_type == 'websocket.disconnect':
-				break
-			if message_type != 'websocket.receive':
-				continue
-
-			binary_data = message.get('bytes')
-			if binary_data is not None:
-				try:
-					assert decoder is not None
-					await decoder.push_bytes(binary_data)
-				except Exception as e:
-					await ws.send_json({
-						'type': 'error',
-						'error': f'audio decode failed: {e}',
-					})
-					await ws.close()
-					break
-				continue
-
-			text_data = message.get('text')
-			if text_data is not None:
-				if _is_stop_message(text_data):
-					break
-				await ws.send_json({
-					'type': 'error',
-					'error': 'invalid control message, expected {"type":"stop"}',
-				})
-				await ws.close()
-				break
+		finished = await _receive_stream(ws, session)
+	except WebSocketDisconnect:
+		finished = False
 	finally:
-		if decoder is not None:
-			try:
-				await decoder.close()
-			except Exception:
-				pass
-
-		if q and q.status in (QueryStatus.WAITING, QueryStatus.PLAYING):
-			q.cancel()
+		if session is not None:
+			# A resumed connection that took the session over owns it now
+			if finished and session.ws is ws:
+				await session.close()
+			else:
+				await session.detach(ws)
@@ -1,10 +1,10 @@
 import asyncio
 import platform
-import re
 import subprocess
 from fastapi import APIRouter, Depends, HTTPException
 from pydantic import BaseModel, Field
 
+from bmaster import volume
 from bmaster.api.auth import require_permissions
 
 
@@ -54,47 +54,13 @@ async def reboot() -> bool:
         return False
     return True
 
-def set_system_volume(percent: int) -> bool:
-    if platform.system() != "Linux":
-        return False
-
-    try:
-        subprocess.run(
-            ["pactl", "set-sink-volume", "@DEFAULT_SINK@", f"{percent}%"],
-            check=True,
-            stdout=subprocess.DEVNULL,
-            stderr=subprocess.DEVNULL,
-        )
-    except Exception:
-        return False
-    return True
-
-
-def get_system_volume() -> int | None:
-    if platform.system() != "Linux":
-        return None
-
-    try:
-        result = subprocess.run(
-            ["pactl", "get-sink-volume", "@DEFAULT_SINK@"],
-            capture_output=True,
-            text=True,
-            check=True,
-        )
-    except Exception:
-        return None
-
-    match = re.search(r"(\d+)%", result.stdout)
-    return int(match.group(1)) if match else None
-
-
 @router.put(
     "/volume",
     response_model=VolumeResponse,
     dependencies=[Depends(require_permissions("bmaster.settings.volume"))],
 )
 async def set_volume(req: VolumeSetRequest) -> VolumeResponse:
-    ok = set_system_volume(req.volume)
+    ok = await volume.set_master(req.volume)
     if not ok:
         raise HTTPException(status_code=500)
     return VolumeResponse(ok=True, volume=req.volume)
@@ -106,10 +72,7 @@ async def set_volume(req: VolumeSetRequest) -> VolumeResponse:
     dependencies=[Depends(require_permissions("bmaster.settings.volume"))],
 )
 async def get_volume() -> VolumeResponse:
-    res = get_system_volume()
-    if res is None:
-        raise HTTPException(status_code=500)
-    return VolumeResponse(ok=True, volume=res)
+    return VolumeResponse(ok=True, volume=await volume.get_master())
 
 
 def _run_update_sync() -> tuple[bool, bool]:
@@ -1,4 +1,5 @@
 import os
+import uuid
 from pathlib import Path
 from typing import Optional
 from fastapi import APIRouter, Depends, HTTPException, UploadFile, status
@@ -15,10 +16,16 @@ from bmaster.api.auth import require_permissions
 router = APIRouter(tags=['sounds'])
 
 SOUNDS_DIR = Path('data/sounds')
+UPLOAD_CHUNK_SIZE = 1024 * 1024
 
 
 class SoundSpecs(BaseModel):
 	duration: float
+	rate: Optional[int] = None
+	channels: Optional[int] = None
+	peak: Optional[float] = None
+	loudness_db: Optional[float] = None
+	hash: Optional[str] = None
 
 class SoundInfo(BaseModel):
 	name: str
@@ -31,20 +38,27 @@ def is_sound_name_valid(name: str) -> bool:
 
 @router.get('/info')
 async def get_sounds() -> list[SoundInfo]:
-	res: list[SoundInfo] = []
-	for file in SOUNDS_DIR.iterdir():
-		if not file.is_file():
-			continue
-		name = file.name
-		sound = sounds.storage.get(name)
-		res.append(
-			SoundInfo(
-				name=name,
-				size=file.stat().st_size,
-				sound_specs=SoundSpecs(duration=sound.duration) if sound else None,
-			)
+	# Served from the metadata index, files are only read again when they change
+	return [
+		SoundInfo(
+			name=meta.name,
+			size=meta.size,
+			sound_specs=SoundSpecs(
+				duration=meta.duration,
+				rate=meta.rate,
+				channels=meta.channels,
+				peak=meta.peak,
+				loudness_db=meta.loudness_db,
+				hash=meta.hash
+			) if meta.duration is not None else None,
 		)
-	return res
+		for meta in sounds.index.values()
+	]
+
+
+@router.get('/mount')
+async def get_mount_progress() -> sounds.MountProgress:
+	return sounds.progress
 
 
 @router.get('/file/{name}')
@@ -71,15 +85,14 @@ async def delete_sound_file(name: str):
 		raise HTTPException(status.HTTP_404_NOT_FOUND, 'File not found')
 
 	os.remove(file_path)
-	sounds.storage.mount_sync()
+	await sounds.remove(name)
 
 
-@router.post('/file', dependencies=[
+@router.post('/file', status_code=status.HTTP_202_ACCEPTED, dependencies=[
 	Depends(require_permissions('bmaster.sounds.manage'))
 ])
-async def upload_sound_file(file: UploadFile):
+async def upload_sound_file(file: UploadFile) -> sounds.SoundJob:
 	name = file.filename
-	print(name)
 	if not is_sound_name_valid(name):
 		raise HTTPException(status.HTTP_400_BAD_REQUEST, 'Invalid file name')
 
@@ -89,6 +102,44 @@ async def upload_sound_file(file: UploadFile):
 			status.HTTP_409_CONFLICT, 'File with this name already exists'
 		)
 
-	async with await anyio.open_file(file_path, 'wb') as f:
-		await f.write(await file.read())
-	sounds.storage.mount_sync()
+	# Starlette has already spooled the whole request by now, the limit keeps oversized files
+	# out of the library but does not bound the spooled request itself
+	max_size = sounds.config.max_upload_size
+	too_large = HTTPException(status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, 'File is too large')
+	if file.size is not None and file.size > max_size:
+		raise too_large
+
+	# Copied in chunks so the upload is never held in memory as a whole
+	temp_path = sounds.uploads_root / f'{uuid.uuid4().hex}.part'
+	try:
+		size = 0
+		async with await anyio.open_file(temp_path, 'wb') as f:
+			while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+				size += len(chunk)
+				if size > max_size:
+					raise too_large
+				await f.write(chunk)
+
+		# Linking claims the name atomically, a concurrent upload of the same name fails here
+		try: os.link(temp_path, file_path)
+		except FileExistsError:
+			raise HTTPException(
+				status.HTTP_409_CONFLICT, 'File with this name already exists'
+			)
+	finally:
+		temp_path.unlink(missing_ok=True)
+
+	return sounds.submit(name)
+
+
+@router.get('/jobs')
+async def get_sound_jobs() -> list[sounds.SoundJob]:
+	return list(sounds.jobs.values())
+
+
+@router.get('/jobs/{id}')
+async def get_sound_job(id: uuid.UUID) -> sounds.SoundJob:
+	job = sounds.jobs.get(id)
+	if not job:
+		raise HTTPException(status.HTTP_404_NOT_FOUND, 'Job not found')
+	return job
@@ -1,9 +1,21 @@
+from abc import ABC, abstractmethod
+import asyncio
+import bisect
+import threading
+import time
+import wave
+from pathlib import Path
+from typing import Any, Callable, Iterable, Literal, Optional
+
 import numpy as np
+from pydantic import BaseModel, Field
+from wauxio import Audio, StreamData
 from wauxio.mixer import AudioMixer
 from wauxio.output import AudioOutput
-import sounddevice as sd
+from wauxio.utils import AudioStack
 
-from bmaster import logs
+from bmaster import configs, logs
+from bmaster.utils.audio import GainRamp, LevelMeter, LinearResampler, to_s16
 
 
 logger = logs.main_logger.getChild('direct')
@@ -11,7 +23,65 @@ logger = logs.main_logger.getChild('direct')
 RATE = 48000
 CHANNELS = 2
 # Audio device callback block duration. Lower value -> lower latency, higher CPU load.
+# Overridden by direct.block_seconds on start.
 DELAY = 0.1
+# Icom stacks of the default mixer hold this many blocks, and at least STACK_MIN_SECONDS
+STACK_BUFFER_FACTOR = 2.0
+STACK_MIN_SECONDS = 0.2
+
+# Playback ratio change per unit of relative fill error, and how fast the drift estimate follows it
+DRIFT_GAIN = 0.001
+DRIFT_INTEGRAL_GAIN = 0.000001
+# Sound card clocks are far better than this, anything beyond is not drift
+DRIFT_MAX_PPM = 1000
+# The fill swings by a whole device block between pulls, the controller follows its average over this long
+DRIFT_SMOOTH_SECONDS = 2.0
+# Corrections this close to 0 play the audio as is instead of resampling it
+DRIFT_DEADBAND_PPM = 20
+
+# Upper edges of the callback duration histogram, as fractions of the block duration.
+# The last bucket counts callbacks that took longer than the whole block.
+CALLBACK_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0)
+# How often new xruns and slow callbacks are logged
+REPORT_INTERVAL = 10.0
+# The file backend starts a new WAV before its 32-bit RIFF sizes overflow
+WAV_ROTATE_BYTES = 2 ** 31
+# Duration of master volume changes
+GAIN_RAMP_SECONDS = 0.05
+
+
+class DirectRouteConfig(BaseModel):
+	icom: str
+	channel: int = Field(ge=0)
+	gain: float = 1.0
+
+class DirectDeviceConfig(BaseModel):
+	# sounddevice device name or index, None for the default device
+	device: Optional[str | int] = None
+	channels: int = Field(gt=0)
+	routes: list[DirectRouteConfig]
+
+# sounddevice - real sound cards
+# null - paced by the monotonic clock, audio is thrown away
+# file - paced like null, audio is written to WAV files
+DirectBackend = Literal['sounddevice', 'null', 'file']
+
+class DirectConfig(BaseModel):
+	backend: DirectBackend = 'sounddevice'
+	# Directory of the file backend, one WAV per device
+	file_path: Path = Path('data/direct')
+	block_seconds: float = Field(default=DELAY, gt=0)
+	# Blocks mixed ahead of the sound card. More blocks survive longer event loop stalls.
+	# At least 2, with a single block the next one can only be mixed after the card drained the ring.
+	buffer_blocks: int = Field(default=2, ge=2)
+	# Multichannel routing. When empty, direct icoms are mixed into both channels
+	# of the default device.
+	devices: list[DirectDeviceConfig] = Field(default_factory=list)
+	# Callbacks taking more than this part of the block duration are reported as slow
+	slow_callback_ratio: float = Field(default=0.5, gt=0)
+
+config: Optional[DirectConfig] = None
+
 
 output_mixer: AudioMixer = AudioMixer()
 output: AudioOutput = AudioOutput(
@@ -20,35 +90,570 @@ output: AudioOutput = AudioOutput(
 )
 output.connect(output_mixer)
 
-out_stream = None
 
-async def start():
-	global out_stream
-	logger.info('Starting output stream...')
+class AudioRing:
+	'''Preallocated single producer, single consumer audio ring.
+	The producer only moves `write_pos` and the consumer only `read_pos`, so neither side locks.'''
+	capacity: int
+	# Absolute sample positions, the ring index is taken modulo capacity
+	write_pos: int = 0
+	read_pos: int = 0
+
+	def __init__(self, capacity: int, channels: int):
+		self.capacity = capacity
+		self.buffer = np.zeros((capacity, channels), dtype=np.float32)
+
+	@property
+	def available(self) -> int:
+		return self.write_pos - self.read_pos
+
+	@property
+	def free(self) -> int:
+		return self.capacity - self.available
+
+	def write(self, data: np.ndarray) -> int:
+		size = min(len(data), self.free)
+		pos = self.write_pos % self.capacity
+		first = min(size, self.capacity - pos)
+		self.buffer[pos:pos + first] = data[:first]
+		self.buffer[:size - first] = data[first:size]
+		self.write_pos += size
+		return size
+
+	def read_into(self, out: np.ndarray) -> int:
+		size = min(len(out), self.available)
+		pos = self.read_pos % self.capacity
+		first = min(size, self.capacity - pos)
+		out[:first] = self.buffer[pos:pos + first]
+		out[first:size] = self.buffer[:size - first]
+		self.read_pos += size
+		return size
+
+
+class DriftCompensator:
+	'''Resamples audio by a ratio slightly off 1 so the buffer it is pushed into stays at its target fill.
+	Icoms tick on the event loop clock while devices play on the sound card clock, without this
+	the buffer between them slowly fills up or runs dry.'''
+	# Samples the buffer should hold
+	target: int
+	# Integral term, settles at the relative drift between the clocks
+	correction: float = 0.0
+	# Input samples per output sample
+	ratio: float = 1.0
+	# Fill averaged over DRIFT_SMOOTH_SECONDS
+	smoothed_fill: float
+
+	def __init__(self, target: int, channels: int):
+		self.target = max(1, target)
+		self.smoothed_fill = float(self.target)
+		self.resampler = LinearResampler(1, 1, channels)
+
+	@property
+	def drift_ppm(self) -> float:
+		return self.correction * 1e6
+
+	def process(self, data: np.ndarray, fill: int) -> np.ndarray:
+		limit = DRIFT_MAX_PPM / 1e6
+		# Exponential average weighted by the pushed duration, so the block sawtooth does not reach the ratio
+		alpha = min(1.0, len(data) / (RATE * DRIFT_SMOOTH_SECONDS))
+		self.smoothed_fill += (fill - self.smoothed_fill) * alpha
+		error = (self.smoothed_fill - self.target) / self.target
+		self.correction = float(np.clip(self.correction + error * DRIFT_INTEGRAL_GAIN, -limit, limit))
+		self.ratio = 1.0 + float(np.clip(self.correction + error * DRIFT_GAIN, -limit, limit))
+		if abs(self.ratio - 1.0) < DRIFT_DEADBAND_PPM / 1e6:
+			return self.resampler.passthrough(data)
+		self.resampler.step = self.ratio
+		return self.resampler.process(data)
+
+
+class FeedStats(BaseModel):
+	icom: str
+	# Routed device index, None for the default mixer
+	device: Optional[int]
+	buffered_seconds: float
+	target_seconds: float
+	drift_ppm: float
+	dropped_samples: int
+	# Device blocks this feed could not fill
+	dry_blocks: int
 
-	def _out_callback(outdata, frames, time, status):
-		outdata.fill(0)
-		duration = frames/RATE
-		frame = output.tick(duration)
+
+class IcomFeed:
+	'''Buffers the mono output of a routed icom until its device mixes it'''
+	icom: str
+	device: int
+	ring: AudioRing
+	drift: DriftCompensator
+	dropped_samples: int = 0
+	dry_blocks: int = 0
+
+	def __init__(self, icom: str, device: int, capacity: int):
+		self.icom = icom
+		self.device = device
+		self.ring = AudioRing(capacity, 1)
+		self.drift = DriftCompensator(capacity // 2, 1)
+
+	def push(self, frame: StreamData):
 		audio = frame.audio
 		if not audio: return
-		data = audio.data
-		outdata[:len(data)] = data
-	
-	out_stream = sd.OutputStream(
-		samplerate=RATE,
-		blocksize=max(1, int(RATE * DELAY)),
-		channels=CHANNELS,
-		dtype=np.float32,
-		callback=_out_callback
+		data = self.drift.process(audio.data, self.ring.available).reshape((-1, 1))
+		self.dropped_samples += len(data) - self.ring.write(data)
+
+	def get_stats(self) -> FeedStats:
+		return FeedStats(
+			icom=self.icom,
+			device=self.device,
+			buffered_seconds=self.ring.available / RATE,
+			target_seconds=self.drift.target / RATE,
+			drift_ppm=self.drift.drift_ppm,
+			dropped_samples=self.dropped_samples,
+			dry_blocks=self.dry_blocks
+		)
+
+
+class StackFeed:
+	'''AudioStack between an icom and the default direct mixer.
+	Its fill is counted from what goes in and out since the stack does not report it.'''
+	icom: str
+	stack: AudioStack
+	drift: DriftCompensator
+	capacity: int
+	buffered: int = 0
+	dropped_samples: int = 0
+	dry_blocks: int = 0
+	# Ran dry since the mixer last checked
+	dry: bool = False
+
+	def __init__(self, icom: str, rate: int, channels: int, samples: int):
+		self.icom = icom
+		self.rate = rate
+		self.channels = channels
+		self.capacity = samples
+		self.stack = AudioStack(rate=rate, channels=channels, samples=samples)
+		self.drift = DriftCompensator(samples // 2, channels)
+
+	def push(self, frame: StreamData):
+		audio = frame.audio
+		if not audio: return
+		data = self.drift.process(audio.data, self.buffered).reshape((-1, self.channels))
+		overflow = max(0, self.buffered + len(data) - self.capacity)
+		self.dropped_samples += overflow
+		self.buffered += len(data) - overflow
+		self.stack.push(StreamData(Audio(data, self.rate)))
+
+	def pull(self, options) -> StreamData:
+		frame = self.stack.pull(options)
+		audio = frame.audio
+		if audio:
+			samples = len(audio.data)
+			if self.buffered < samples:
+				self.dry_blocks += 1
+				self.dry = True
+			self.buffered = max(0, self.buffered - samples)
+		return frame
+
+	def get_stats(self) -> FeedStats:
+		return FeedStats(
+			icom=self.icom,
+			device=None,
+			buffered_seconds=self.buffered / self.rate,
+			target_seconds=self.drift.target / self.rate,
+			drift_ppm=self.drift.drift_ppm,
+			dropped_samples=self.dropped_samples,
+			dry_blocks=self.dry_blocks
+		)
+
+
+class DeviceStats(BaseModel):
+	device: Optional[str | int]
+	channels: int
+	blocks: int
+	# Callbacks that found less audio than the sound card asked for
+	xruns: int
+	xrun_samples: int
+	# Flags reported by the sound card itself
+	output_underflows: int
+	output_overflows: int
+	# Mixed blocks where at least one icom had no audio ready
+	dry_blocks: int
+	buffered_seconds: float
+	buffer_seconds: float
+	callback_budget_ms: float
+	callback_max_ms: float
+	slow_callbacks: int
+	# Callback counts per CALLBACK_BUCKETS edge, the last one is over budget
+	callback_buckets: list[float]
+	callback_histogram: list[int]
+
+class DirectStats(BaseModel):
+	devices: list[DeviceStats]
+	feeds: list[FeedStats]
+
+
+AudioCallback = Callable[[np.ndarray, int, Any, Any], None]
+
+
+class ClockedStream:
+	'''Stand-in for a sound card stream without audio hardware.
+	Calls the callback like sounddevice does, paced by the monotonic clock on its own thread.'''
+	channels: int
+	block: int
+
+	def __init__(self, channels: int, block: int, callback: AudioCallback):
+		self.channels = channels
+		self.block = block
+		self.callback = callback
+		self._stopped = threading.Event()
+		self._thread = threading.Thread(target=self._run, name='direct-clock', daemon=True)
+
+	def start(self):
+		self._thread.start()
+
+	def close(self):
+		self._stopped.set()
+		self._thread.join()
+
+	def write(self, data: np.ndarray):
+		pass
+
+	def _run(self):
+		outdata = np.zeros((self.block, self.channels), dtype=np.float32)
+		duration = self.block / RATE
+		deadline = time.monotonic()
+		errors = 0
+		next_error_log = 0.0
+		while not self._stopped.is_set():
+			# A failing block must not stop the clock, it would silence the device without any xrun
+			try:
+				self.callback(outdata, self.block, None, None)
+				self.write(outdata)
+			except Exception as e:
+				errors += 1
+				now = time.monotonic()
+				if now >= next_error_log:
+					next_error_log = now + REPORT_INTERVAL
+					logger.error(f'Clocked stream block failed ({errors} so far)', exc_info=e)
+			deadline += duration
+			delay = deadline - time.monotonic()
+			if delay > 0:
+				self._stopped.wait(delay)
+
+
+class WavFileStream(ClockedStream):
+	'''Clocked stream recording everything it plays into s16 WAV files.
+	Long runs continue in numbered parts next to the first file (output-0.1.wav, ...).'''
+
+	def __init__(self, channels: int, block: int, callback: AudioCallback, path: Path):
+		super().__init__(channels, block, callback)
+		self.path = path
+		self._file: Optional[wave.Wave_write] = None
+		self._part = 0
+		self._written = 0
+
+	def _open(self):
+		path = self.path
+		if self._part:
+			path = path.with_name(f'{path.stem}.{self._part}{path.suffix}')
+		self._file = wave.open(str(path), 'wb')
+		self._file.setnchannels(self.channels)
+		self._file.setsampwidth(2)
+		self._file.setframerate(RATE)
+		self._written = 0
+
+	def start(self):
+		self.path.parent.mkdir(parents=True, exist_ok=True)
+		self._open()
+		super().start()
+
+	def close(self):
+		super().close()
+		if self._file is not None:
+			self._file.close()
+			self._file = None
+
+	def write(self, data: np.ndarray):
+		frames = to_s16(data).tobytes()
+		if self._written + len(frames) > WAV_ROTATE_BYTES:
+			self._file.close()
+			self._part += 1
+			self._open()
+			logger.info(f'{self.path.name} continues in part {self._part}')
+		self._file.writeframes(frames)
+		self._written += len(frames)
+
+
+class OutputDevice(ABC):
+	'''Sound card stream that only copies blocks mixed ahead of time into its ring'''
+	device: Optional[str | int]
+	channels: int
+	block: int
+	ring: AudioRing
+	# sounddevice.OutputStream or ClockedStream
+	stream: Optional[Any] = None
+	blocks: int = 0
+	xruns: int = 0
+	xrun_samples: int = 0
+	output_underflows: int = 0
+	output_overflows: int = 0
+	dry_blocks: int = 0
+	slow_callbacks: int = 0
+	callback_max: float = 0.0
+
+	def __init__(self, device: Optional[str | int], channels: int, block: int, buffer_blocks: int):
+		self.device = device
+		self.channels = channels
+		self.block = block
+		self.ring = AudioRing(block * buffer_blocks, channels)
+		self.gain = GainRamp(int(RATE * GAIN_RAMP_SECONDS), master_gain)
+		self.meter = LevelMeter(channels)
+		self.callback_histogram = [0] * (len(CALLBACK_BUCKETS) + 1)
+		# Counters at the last report
+		self._reported = (0, 0, 0, 0)
+
+	@abstractmethod
+	def fill(self):
+		'''Mixes blocks into the ring while there is room for them'''
+
+	def _callback(self, outdata, frames, time_info, status):
+		# Runs on the PortAudio thread, keep it to copies and counters
+		started = time.perf_counter()
+		self.blocks += 1
+		if status:
+			if status.output_underflow: self.output_underflows += 1
+			if status.output_overflow: self.output_overflows += 1
+		read = self.ring.read_into(outdata)
+		if read < frames:
+			outdata[read:].fill(0)
+			self.xruns += 1
+			self.xrun_samples += frames - read
+
+		elapsed = time.perf_counter() - started
+		ratio = elapsed * RATE / frames
+		self.callback_histogram[bisect.bisect_left(CALLBACK_BUCKETS, ratio)] += 1
+		if ratio > config.slow_callback_ratio: self.slow_callbacks += 1
+		if elapsed > self.callback_max: self.callback_max = elapsed
+
+	def report(self):
+		'''Logs xruns and slow callbacks since the last report, if there were any'''
+		counters = (self.xruns, self.output_underflows, self.slow_callbacks, self.dry_blocks)
+		xruns, underflows, slow, dry = (now - last for now, last in zip(counters, self._reported))
+		self._reported = counters
+		if not (xruns or underflows or slow): return
+		# Slow callbacks point to CPU starvation, xruns with fast callbacks and dry blocks
+		# to the event loop not scheduling the mixing in time
+		logger.warning(
+			f'Output device {self.device if self.device is not None else "default"}: '
+			f'{xruns} xruns, {underflows} underflows, {slow} slow callbacks, {dry} dry blocks '
+			f'in the last {REPORT_INTERVAL:.0f} s (max callback {self.callback_max * 1000:.2f} ms)'
+		)
+
+	def open(self, backend: DirectBackend, index: int):
+		if backend == 'null':
+			stream = ClockedStream(self.channels, self.block, self._callback)
+		elif backend == 'file':
+			stream = WavFileStream(self.channels, self.block, self._callback, config.file_path / f'output-{index}.wav')
+		else:
+			# Imported here so the other backends work without PortAudio
+			import sounddevice as sd
+			stream = sd.OutputStream(
+				device=self.device,
+				samplerate=RATE,
+				blocksize=self.block,
+				channels=self.channels,
+				dtype=np.float32,
+				callback=self._callback
+			)
+		stream.start()
+		self.stream = stream
+
+	def close(self):
+		if self.stream is not None:
+			self.stream.close()
+			self.stream = None
+
+	def get_stats(self) -> DeviceStats:
+		return DeviceStats(
+			device=self.device,
+			channels=self.channels,
+			blocks=self.blocks,
+			xruns=self.xruns,
+			xrun_samples=self.xrun_samples,
+			output_underflows=self.output_underflows,
+			output_overflows=self.output_overflows,
+			dry_blocks=self.dry_blocks,
+			buffered_seconds=self.ring.available / RATE,
+			buffer_seconds=self.ring.capacity / RATE,
+			callback_budget_ms=self.block / RATE * 1000,
+			callback_max_ms=self.callback_max * 1000,
+			slow_callbacks=self.slow_callbacks,
+			callback_buckets=list(CALLBACK_BUCKETS),
+			callback_histogram=list(self.callback_histogram)
+		)
+
+
+class MixerDevice(OutputDevice):
+	'''Default device playing `output`, every direct icom on every channel'''
+
+	def __init__(self, block: int, buffer_blocks: int):
+		super().__init__(None, CHANNELS, block, buffer_blocks)
+		self._silence = np.zeros((block, CHANNELS), dtype=np.float32)
+
+	def fill(self):
+		duration = self.block / RATE
+		while self.ring.free >= self.block:
+			frame = output.tick(duration)
+			audio = frame.audio
+			data = self.gain.process(audio.data) if audio else self._silence
+			self.meter.update(data)
+			self.ring.write(data)
+			dry = [feed for feed in feeds if isinstance(feed, StackFeed) and feed.dry]
+			if dry:
+				self.dry_blocks += 1
+				for feed in dry: feed.dry = False
+
+
+class RoutedDevice(OutputDevice):
+	'''Multichannel device mixing icom feeds into its channels with a gain matrix'''
+	feeds: list[IcomFeed]
+	# (icoms, channels) gain of every icom on every device channel
+	gains: np.ndarray
+
+	def __init__(self, index: int, config: DirectDeviceConfig, block: int, buffer_blocks: int):
+		super().__init__(config.device, config.channels, block, buffer_blocks)
+		icom_ids = list(dict.fromkeys(route.icom for route in config.routes))
+		# Every device has its own feeds, sound cards do not share a clock
+		self.feeds = [IcomFeed(icom_id, index, block * (buffer_blocks + 1)) for icom_id in icom_ids]
+		self.gains = np.zeros((len(icom_ids), config.channels), dtype=np.float32)
+		for route in config.routes:
+			if route.channel >= config.channels:
+				raise ValueError(f'Device {config.device} has no channel {route.channel}')
+			self.gains[icom_ids.index(route.icom), route.channel] += route.gain
+		self._inputs = np.zeros((block, len(icom_ids)), dtype=np.float32)
+		self._mix = np.zeros((block, config.channels), dtype=np.float32)
+
+	def remove_icom(self, icom_id: str):
+		'''Drops the routes of an icom along with its feed'''
+		index = next(i for i, feed in enumerate(self.feeds) if feed.icom == icom_id)
+		del self.feeds[index]
+		self.gains = np.delete(self.gains, index, axis=0)
+		self._inputs = np.zeros((self.block, len(self.feeds)), dtype=np.float32)
+
+	def fill(self):
+		inputs = self._inputs
+		while self.ring.free >= self.block:
+			dry = False
+			for i, feed in enumerate(self.feeds):
+				read = feed.ring.read_into(inputs[:, i:i + 1])
+				if read < self.block:
+					inputs[read:, i] = 0
+					feed.dry_blocks += 1
+					dry = True
+			if dry: self.dry_blocks += 1
+			np.matmul(inputs, self.gains, out=self._mix)
+			data = self.gain.process(self._mix)
+			self.meter.update(data)
+			self.ring.write(data)
+
+
+feeds: list[IcomFeed | StackFeed] = list()
+devices: list[OutputDevice] = list()
+_producer_task: Optional[asyncio.Task] = None
+# Software master volume of every device
+master_gain: float = 1.0
+
+
+def set_master_gain(gain: float):
+	global master_gain
+	master_gain = gain
+	for device in devices:
+		device.gain.set(gain)
+
+def is_routed(icom_id: str) -> bool:
+	return any(route.icom == icom_id for device in config.devices for route in device.routes)
+
+def drop_unknown_routes(icom_ids: Iterable[str]):
+	'''Removes routes to icoms that do not exist, their feeds would never get audio and count as dry on every block'''
+	known = set(icom_ids)
+	for device in devices:
+		if not isinstance(device, RoutedDevice): continue
+		for feed in list(device.feeds):
+			if feed.icom in known: continue
+			logger.warning(f"Device {device.device} is routed to unknown icom '{feed.icom}', ignoring its routes")
+			device.remove_icom(feed.icom)
+
+def connect_icom(icom_id: str, icom_output: AudioOutput) -> bool:
+	'''Plays an icom on the direct output, False if no device would play it'''
+	if config.devices:
+		icom_feeds = [
+			feed
+			for device in devices if isinstance(device, RoutedDevice)
+			for feed in device.feeds if feed.icom == icom_id
+		]
+		if not icom_feeds: return False
+	else:
+		rate = icom_output.rate
+		buffer_seconds = max(DELAY * STACK_BUFFER_FACTOR, STACK_MIN_SECONDS)
+		feed = StackFeed(icom_id, rate, icom_output.channels, max(1, int(rate * buffer_seconds)))
+		output_mixer.add(feed.pull)
+		icom_feeds = [feed]
+
+	for feed in icom_feeds:
+		icom_output.listen(feed.push)
+		feeds.append(feed)
+	return True
+
+def get_stats() -> DirectStats:
+	return DirectStats(
+		devices=[device.get_stats() for device in devices],
+		feeds=[feed.get_stats() for feed in feeds]
 	)
 
-	out_stream.start()
-	logger.info('Output stream started')
+
+async def _produce():
+	'''Mixes blocks on the event loop ahead of the sound cards, keeping their rings full'''
+	interval = DELAY / 2
+	next_report = time.monotonic() + REPORT_INTERVAL
+	errors = 0
+	next_error_log = 0.0
+	while True:
+		for device in devices:
+			# One failing mix must not end the task, every device would play silence until restart
+			try: device.fill()
+			except Exception as e:
+				errors += 1
+				now = time.monotonic()
+				if now >= next_error_log:
+					next_error_log = now + REPORT_INTERVAL
+					logger.error(f'Mixing for device {device.device} failed ({errors} so far)', exc_info=e)
+		if time.monotonic() >= next_report:
+			next_report += REPORT_INTERVAL
+			for device in devices:
+				device.report()
+		await asyncio.sleep(interval)
+
+
+async def start():
+	global config, _producer_task, DELAY
+	config = DirectConfig.model_validate(configs.get('direct', None) or {})
+	DELAY = config.block_seconds
+	block = max(1, int(RATE * DELAY))
+
+	if config.devices:
+		for index, device_config in enumerate(config.devices):
+			devices.append(RoutedDevice(index, device_config, block, config.buffer_blocks))
+	else:
+		devices.append(MixerDevice(block, config.buffer_blocks))
+
+	logger.info(f"Starting output streams ({config.backend})...")
+	_producer_task = asyncio.create_task(_produce())
+	for index, device in enumerate(devices):
+		device.open(config.backend, index)
+	logger.info(f'{len(devices)} output stream(s) started ({DELAY * 1000:.0f} ms blocks, {config.buffer_blocks} buffered)')
 
 async def stop():
-	global out_stream
-	logger.info('Closing output stream...')
-	if out_stream is not None:
-		out_stream.close()
-	logger.info('Output stream closed')
+	logger.info('Closing output streams...')
+	for device in devices:
+		device.close()
+	if _producer_task is not None:
+		_producer_task.cancel()
+	logger.info('Output streams closed')
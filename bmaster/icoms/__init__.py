@@ -1,21 +1,24 @@
 import asyncio
 from typing import Mapping, Optional
-from pydantic import BaseModel, SerializeAsAny
+from pydantic import BaseModel, Field, SerializeAsAny
+from wauxio import Audio, StreamData
 from wauxio.output import AudioOutput
 from wauxio.mixer import AudioMixer
-from wauxio.utils import AudioStack
 
 from bmaster import direct, logs
 from bmaster.utils import aio
+from bmaster.utils.audio import GainRamp, LevelMeter
 from .queries import PlayOptions, Query, QueryInfo
+from .hubs import ListenConfig
+from .history import AudioHistory
 from bmaster import configs
 
 
 logger = logs.main_logger.getChild('icoms')
 
 ICOM_TICK_DELAY = 0.01
-DIRECT_MIN_BUFFER_SECONDS = 0.2
-DIRECT_BUFFER_FACTOR = 2.0
+# Duration of volume changes
+GAIN_RAMP_SECONDS = 0.05
 
 class IcomInfo(BaseModel):
 	id: str
@@ -33,6 +36,10 @@ class Icom:
 	mixer: AudioMixer
 	paused: bool = False
 	output: AudioOutput
+	# Recent output for listen preroll and replay
+	history: Optional[AudioHistory] = None
+	gain: GainRamp
+	meter: LevelMeter
 
 	def __init__(self, icom_id: str):
 		self.id = icom_id
@@ -41,10 +48,21 @@ class Icom:
 			rate=48000,
 			channels=1
 		)
-		output.connect(mixer.mix)
+		output.connect(self._mix)
 		self.queue = list()
 		self.mixer = mixer
 		self.output = output
+		self.gain = GainRamp(int(output.rate * GAIN_RAMP_SECONDS))
+		self.meter = LevelMeter(output.channels)
+
+	def _mix(self, options) -> StreamData:
+		frame = self.mixer.mix(options)
+		audio = frame.audio
+		if not audio: return frame
+		data = self.gain.process(audio.data)
+		self.meter.update(data)
+		if data is audio.data: return frame
+		return StreamData(Audio(data, audio.rate))
 	
 	def run(self):
 		return self.output.run(ICOM_TICK_DELAY)
@@ -135,9 +153,25 @@ def get(icom_id: str) -> Optional[Icom]:
 class IcomConfig(BaseModel):
 	name: Optional[str] = None
 	direct: bool = False
+	# Length of the output history ring, 0 disables preroll and replay
+	history_seconds: float = Field(default=10.0, ge=0)
+
+class SilenceConfig(BaseModel):
+	# Blocks with RMS below this are silent
+	threshold_db: float = -50.0
+	# Sound has to rise this far above the threshold to end silence
+	hysteresis_db: float = Field(default=6.0, ge=0)
+	# Live streams silent for this long are ended, 0 disables
+	stream_timeout: float = Field(default=30.0, ge=0)
+	# Cut leading and trailing silence from uploaded audio
+	trim: bool = True
+	# Seconds of silence kept around trimmed audio
+	trim_padding: float = Field(default=0.1, ge=0)
 
 class IcomsConfig(BaseModel):
 	icoms: dict[str, IcomConfig]
+	listen: ListenConfig = Field(default_factory=ListenConfig)
+	silence: SilenceConfig = Field(default_factory=SilenceConfig)
 
 config: Optional[IcomsConfig] = None
 
@@ -151,18 +185,19 @@ async def start():
 	for icom_id, icom_config in config.icoms.items():
 		icom = Icom(icom_id)
 		icom.name = icom_config.name
-		if icom_config.direct:
-			rate = icom.output.rate
-			channels = icom.output.channels
-			buffer_seconds = max(direct.DELAY * DIRECT_BUFFER_FACTOR, DIRECT_MIN_BUFFER_SECONDS)
-			stack = AudioStack(
-				rate=rate,
-				channels=channels,
-				samples=max(1, int(rate * buffer_seconds))
+		if icom_config.history_seconds:
+			history = AudioHistory(
+				rate=icom.output.rate,
+				channels=icom.output.channels,
+				seconds=icom_config.history_seconds
 			)
-			icom.output.listen(stack.push)
-			direct.output_mixer.add(stack.pull)
+			icom.output.listen(history.push)
+			icom.history = history
+		if icom_config.direct or direct.is_routed(icom_id):
+			if not direct.connect_icom(icom_id, icom.output):
+				logger.warning(f"Icom '{icom_id}' is direct but has no routes in the direct config, it is not played")
 		_icoms_map[icom_id] = icom
 		asyncio.create_task(icom.run())
+	direct.drop_unknown_routes(config.icoms.keys())
 
 	logger.debug('Icoms initialized')
@@ -0,0 +1,106 @@
+import asyncio
+from typing import Callable, Optional
+
+import numpy as np
+
+from bmaster import logs
+from bmaster.utils.ogg import OggPageReader, page_granule
+
+
+logger = logs.main_logger.getChild('encoding')
+
+# Ogg page duration of the encoded stream. Shorter pages mean lower listen latency.
+OPUS_PAGE_MICROSECONDS = 20000
+
+
+class FFmpegOpusEncoder:
+	'''Encodes float32 PCM into an Ogg/Opus stream page by page'''
+	process: asyncio.subprocess.Process
+	# Stream header pages (OpusHead, OpusTags) that every new consumer needs first
+	header: list[bytes]
+
+	def __init__(self, process: asyncio.subprocess.Process, on_page: Callable[[bytes], None]):
+		self.process = process
+		self.header = list()
+		self._on_page = on_page
+		self._reader = OggPageReader()
+		self._in_header = True
+		self._stdout_task: Optional[asyncio.Task] = None
+		self._closed = False
+
+	@classmethod
+	async def create(cls, rate: int, channels: int, bitrate: int, on_page: Callable[[bytes], None]) -> 'FFmpegOpusEncoder':
+		process = await asyncio.create_subprocess_exec(
+			'ffmpeg',
+			'-hide_banner',
+			'-loglevel',
+			'error',
+			'-f',
+			'f32le',
+			'-ar',
+			str(rate),
+			'-ac',
+			str(channels),
+			'-i',
+			'pipe:0',
+			'-c:a',
+			'libopus',
+			'-b:a',
+			str(bitrate),
+			'-application',
+			'lowdelay',
+			'-frame_duration',
+			'20',
+			'-page_duration',
+			str(OPUS_PAGE_MICROSECONDS),
+			'-flush_packets',
+			'1',
+			'-f',
+			'ogg',
+			'pipe:1',
+			stdin=asyncio.subprocess.PIPE,
+			stdout=asyncio.subprocess.PIPE,
+			stderr=asyncio.subprocess.DEVNULL,
+		)
+		encoder = cls(process, on_page)
+		encoder._stdout_task = asyncio.create_task(encoder._read_stdout())
+		return encoder
+
+	async def _read_stdout(self):
+		try:
+			assert self.process.stdout is not None
+			while True:
+				chunk = await self.process.stdout.read(4096)
+				if not chunk:
+					break
+				for page in self._reader.feed(chunk):
+					if self._in_header:
+						if page_granule(page) == 0:
+							self.header.append(page)
+						else:
+							self._in_header = False
+					self._on_page(page)
+		except Exception as e:
+			logger.error('Opus encoder output failed', exc_info=e)
+
+	def write(self, data: np.ndarray):
+		'''Writes PCM without waiting, the encoder runs far faster than real time'''
+		stdin = self.process.stdin
+		if self._closed or stdin is None or stdin.is_closing():
+			return
+		stdin.write(np.ascontiguousarray(data, dtype=np.float32).tobytes())
+
+	async def close(self):
+		if self._closed:
+			return
+		self._closed = True
+
+		if self.process.stdin is not None and not self.process.stdin.is_closing():
+			self.process.stdin.close()
+		try:
+			await asyncio.wait_for(self.process.wait(), timeout=1.0)
+		except asyncio.TimeoutError:
+			self.process.kill()
+			await self.process.wait()
+		if self._stdout_task is not None:
+			await asyncio.gather(self._stdout_task, return_exceptions=True)
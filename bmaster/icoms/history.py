@@ -0,0 +1,68 @@
+import io
+import wave
+
+import numpy as np
+from wauxio import StreamData
+
+from bmaster.utils.audio import to_s16
+
+
+class AudioHistory:
+	'''Preallocated ring buffer holding the last seconds of an audio output'''
+	rate: int
+	channels: int
+	capacity: int
+	# Total samples ever written, absolute stream position of the ring end
+	written: int = 0
+
+	def __init__(self, rate: int, channels: int, seconds: float):
+		self.rate = rate
+		self.channels = channels
+		self.capacity = max(1, int(rate * seconds))
+		self.buffer = np.zeros((self.capacity, channels), dtype=np.float32)
+
+	@property
+	def oldest(self) -> int:
+		return max(0, self.written - self.capacity)
+
+	def push(self, frame: StreamData):
+		audio = frame.audio
+		if not audio: return
+		self.write(audio.data)
+
+	def write(self, data: np.ndarray):
+		data = data.reshape((-1, self.channels))
+		capacity = self.capacity
+		size = len(data)
+		if size > capacity:
+			self.written += size - capacity
+			data = data[-capacity:]
+			size = capacity
+
+		pos = self.written % capacity
+		first = min(size, capacity - pos)
+		self.buffer[pos:pos + first] = data[:first]
+		if first < size:
+			self.buffer[:size - first] = data[first:]
+		self.written += size
+
+	def read(self, start: int, end: int) -> np.ndarray:
+		'''Copies samples between absolute stream positions, clamped to what is still held'''
+		start = max(start, self.oldest)
+		end = min(end, self.written)
+		if end <= start:
+			return np.zeros((0, self.channels), dtype=np.float32)
+		return np.take(self.buffer, np.arange(start, end) % self.capacity, axis=0)
+
+	def read_last(self, seconds: float) -> np.ndarray:
+		return self.read(self.written - int(seconds * self.rate), self.written)
+
+	def to_wav(self, seconds: float) -> bytes:
+		data = self.read_last(seconds)
+		res = io.BytesIO()
+		with wave.open(res, 'wb') as f:
+			f.setnchannels(self.channels)
+			f.setsampwidth(2)
+			f.setframerate(self.rate)
+			f.writeframes(to_s16(data).tobytes())
+		return res.getvalue()
@@ -0,0 +1,362 @@
+import asyncio
+from dataclasses import dataclass, replace
+from typing import Literal, Optional
+
+import numpy as np
+from wauxio import Audio, StreamData
+from wauxio.output import AudioOutput
+from wauxio.utils import AudioDrain
+from pydantic import BaseModel, Field
+
+from bmaster import logs
+from bmaster.utils import aio
+from bmaster.utils.audio import BlockDecimator, LinearResampler, make_resampler, to_s16
+from .encoding import FFmpegOpusEncoder
+from .history import AudioHistory
+
+
+logger = logs.main_logger.getChild('hubs')
+
+# Chunks a listener may fall behind before its overflow policy applies
+LISTEN_QUEUE_CHUNKS = 8
+# Downgraded listeners never go below this rate
+LISTEN_MIN_RATE = 8000
+LISTEN_MIN_OPUS_BITRATE = 8000
+# Bounds of the listen chunk duration
+LISTEN_MIN_CHUNK_SECONDS = 0.001
+LISTEN_MAX_CHUNK_SECONDS = 10
+# Drain block of opus hubs, the encoder frames the audio itself
+OPUS_DRAIN_SECONDS = 0.02
+
+ListenEncoding = Literal['pcm', 'opus']
+# Sample format of pcm listen streams
+ListenFormat = Literal['f32', 's16']
+
+# What to do with a listener whose send queue is full:
+# drop_oldest - drop the oldest queued chunk and keep going
+# downgrade - move the listener to a hub with half the sample rate
+# disconnect - close the listener with a reason
+OverflowPolicy = Literal['drop_oldest', 'downgrade', 'disconnect']
+
+
+class ListenConfig(BaseModel):
+	queue_chunks: int = Field(default=LISTEN_QUEUE_CHUNKS, gt=0)
+	overflow: OverflowPolicy = 'drop_oldest'
+	# Recent audio sent to a new listener right away, taken from the icom history
+	preroll_seconds: float = Field(default=0.5, ge=0)
+	# Simultaneous HTTP live streams per icom
+	live_max_clients: int = Field(default=16, gt=0)
+
+
+class ListenOverflow(Exception):
+	'''Raised to the sender of a listener that could not keep up'''
+	pass
+
+class ListenError(Exception):
+	'''Raised to the sender of a listener whose hub can not produce audio'''
+	pass
+
+
+@dataclass(frozen=True)
+class ListenKey:
+	rate: int
+	channels: int
+	chunk_size: int
+	encoding: ListenEncoding = 'pcm'
+	format: ListenFormat = 'f32'
+	# Opus only
+	bitrate: Optional[int] = None
+
+	def lower(self) -> Optional['ListenKey']:
+		'''Same stream at half the rate (or bitrate), None if it can not be lowered further'''
+		if self.encoding == 'opus':
+			bitrate = self.bitrate // 2
+			if bitrate < LISTEN_MIN_OPUS_BITRATE:
+				return None
+			return replace(self, bitrate=bitrate)
+		rate = self.rate // 2
+		if rate < LISTEN_MIN_RATE:
+			return None
+		return replace(self, rate=rate, chunk_size=max(1, self.chunk_size // 2))
+
+
+class ListenerInfo(BaseModel):
+	rate: int
+	channels: int
+	chunk_size: int
+	encoding: ListenEncoding
+	format: ListenFormat
+	bitrate: Optional[int]
+	overflow: OverflowPolicy
+	queued: int
+	sent: int
+	dropped: int
+	downgrades: int
+
+
+class ListenSubscriber:
+	'''Listener of a `ListenHub` with a bounded queue of shared encoded chunks'''
+	hub: 'ListenHub'
+	queue: asyncio.Queue[Optional[bytes]]
+	overflow: OverflowPolicy
+	sent: int = 0
+	dropped: int = 0
+	downgrades: int = 0
+	overflowed: bool = False
+	closed: bool = False
+	# Why the hub stopped producing audio for this listener
+	error: Optional[str] = None
+
+	def __init__(self, hub: 'ListenHub', max_chunks: int = LISTEN_QUEUE_CHUNKS, overflow: OverflowPolicy = 'drop_oldest'):
+		self.hub = hub
+		self.overflow = overflow
+		# One extra slot for the overflow marker
+		self.queue = asyncio.Queue(max_chunks + 1)
+		self.max_chunks = max_chunks
+
+	def offer(self, chunk: bytes):
+		if self.overflowed or self.error:
+			self.dropped += 1
+			return
+		queue = self.queue
+		if queue.qsize() < self.max_chunks:
+			queue.put_nowait(chunk)
+			return
+
+		if self.overflow == 'drop_oldest':
+			queue.get_nowait()
+			queue.put_nowait(chunk)
+			self.dropped += 1
+			return
+
+		# Drop everything queued and wake the sender up with the overflow marker
+		self.overflowed = True
+		self.dropped += queue.qsize() + 1
+		while not queue.empty():
+			queue.get_nowait()
+		queue.put_nowait(None)
+
+	def fail(self, error: str):
+		'''Drops everything queued and wakes the sender up with the error'''
+		self.error = error
+		queue = self.queue
+		while not queue.empty():
+			queue.get_nowait()
+		queue.put_nowait(None)
+
+	async def get(self) -> bytes:
+		chunk = await self.queue.get()
+		if chunk is None:
+			if self.error:
+				raise ListenError(self.error)
+			raise ListenOverflow()
+		self.sent += 1
+		return chunk
+
+	def get_info(self) -> ListenerInfo:
+		key = self.hub.key
+		return ListenerInfo(
+			rate=key.rate,
+			channels=key.channels,
+			chunk_size=key.chunk_size,
+			encoding=key.encoding,
+			format=key.format,
+			bitrate=key.bitrate,
+			overflow=self.overflow,
+			queued=self.queue.qsize(),
+			sent=self.sent,
+			dropped=self.dropped,
+			downgrades=self.downgrades
+		)
+
+	def close(self):
+		if self.closed: return
+		self.closed = True
+		self.hub.unsubscribe(self)
+
+
+class ListenHub:
+	'''Drains an audio output once and shares every encoded chunk between all subscribers'''
+	output: AudioOutput
+	key: ListenKey
+	drain: Optional[AudioDrain] = None
+	resampler: Optional[LinearResampler | BlockDecimator] = None
+	history: Optional[AudioHistory]
+	# Output samples per drained chunk
+	src_chunk_size: int = 0
+	# History position where the drain was attached and output samples drained since
+	origin: int = 0
+	drained: int = 0
+
+	def __init__(self, output: AudioOutput, key: ListenKey, history: Optional[AudioHistory] = None):
+		self.output = output
+		self.key = key
+		self.history = history
+		self.subscribers: list[ListenSubscriber] = list()
+
+	def _encode(self, data: np.ndarray, resampler: Optional[LinearResampler | BlockDecimator]) -> bytes:
+		if resampler is not None:
+			data = resampler.process(data)
+		if self.key.format == 's16':
+			return to_s16(data).tobytes()
+		return data.tobytes()
+
+	def encode(self, audio: Audio) -> bytes:
+		return self._encode(audio.data, self.resampler)
+
+	def preroll(self, seconds: float) -> list[bytes]:
+		'''Encodes whole chunks of history that end exactly where the next live chunk starts'''
+		history = self.history
+		if history is None or seconds <= 0 or not self.src_chunk_size:
+			return []
+		end = self.origin + self.drained
+		chunks = int(seconds * self.output.rate) // self.src_chunk_size
+		data = history.read(end - chunks * self.src_chunk_size, end)
+		if not len(data):
+			return []
+		key = self.key
+		encoded = self._encode(data, make_resampler(self.output.rate, key.rate, key.channels))
+		chunk_bytes = key.chunk_size * key.channels * (2 if key.format == 's16' else 4)
+		return [encoded[i:i + chunk_bytes] for i in range(0, len(encoded), chunk_bytes)]
+
+	def _write(self, frame: StreamData):
+		audio = frame.audio
+		if not audio: return
+		self.drained += len(audio.data)
+		chunk = self.encode(audio)
+		for subscriber in self.subscribers:
+			subscriber.offer(chunk)
+
+	def _attach(self):
+		key = self.key
+		# Drain at the output rate and resample explicitly, chunk_size counts output samples
+		src_rate = self.output.rate
+		self.resampler = make_resampler(src_rate, key.rate, key.channels)
+		self.src_chunk_size = max(1, round(key.chunk_size * src_rate / key.rate))
+		self.origin = self.history.written if self.history else 0
+		self.drained = 0
+		self.drain = AudioDrain(
+			rate=src_rate,
+			channels=key.channels,
+			samples=self.src_chunk_size,
+			output=self._write
+		)
+		self.output.listen(self.drain.push)
+
+	def _detach(self):
+		drain = self.drain
+		self.drain = None
+		if drain is not None:
+			self.output.outputs.remove(drain.push)
+
+	def subscribe(self, max_chunks: int = LISTEN_QUEUE_CHUNKS, overflow: OverflowPolicy = 'drop_oldest', preroll: float = 0) -> ListenSubscriber:
+		subscriber = ListenSubscriber(self, max_chunks, overflow)
+		self.subscribers.append(subscriber)
+		if self.drain is None:
+			self._attach()
+		try:
+			for chunk in self.preroll(preroll)[-max_chunks:]:
+				subscriber.offer(chunk)
+		except Exception:
+			self.unsubscribe(subscriber)
+			raise
+		return subscriber
+
+	def unsubscribe(self, subscriber: ListenSubscriber):
+		try: self.subscribers.remove(subscriber)
+		except ValueError: return
+		if not self.subscribers:
+			self._detach()
+			self._forget()
+
+	def _forget(self):
+		# A failed hub may already have been replaced by a new one for the same key
+		hub_key = (id(self.output), self.key)
+		if _hubs.get(hub_key) is self:
+			del _hubs[hub_key]
+
+
+class OpusListenHub(ListenHub):
+	'''Encodes the output once into Ogg/Opus pages shared by all subscribers'''
+	encoder: Optional[FFmpegOpusEncoder] = None
+
+	def _write(self, frame: StreamData):
+		audio = frame.audio
+		encoder = self.encoder
+		if not audio or encoder is None: return
+		encoder.write(audio.data)
+
+	def _on_page(self, page: bytes):
+		for subscriber in self.subscribers:
+			subscriber.offer(page)
+
+	def _attach(self):
+		super()._attach()
+		aio.run(self._start_encoder())
+
+	async def _start_encoder(self):
+		key = self.key
+		try:
+			encoder = await FFmpegOpusEncoder.create(self.output.rate, key.channels, key.bitrate, self._on_page)
+		except Exception as e:
+			logger.error('Failed to start opus encoder', exc_info=e)
+			# Listeners would otherwise wait forever for a page, the next one to join retries
+			self._detach()
+			self._forget()
+			for subscriber in self.subscribers:
+				subscriber.fail('opus encoder failed to start')
+			return
+		if self.drain is None:
+			# Everyone left while the encoder was starting
+			await encoder.close()
+			return
+		self.encoder = encoder
+
+	def _detach(self):
+		super()._detach()
+		encoder = self.encoder
+		self.encoder = None
+		if encoder is not None:
+			aio.run(encoder.close())
+
+	def preroll(self, seconds: float) -> list[bytes]:
+		# The encoder state can not be rewound, opus listeners start live
+		return []
+
+	def subscribe(self, max_chunks: int = LISTEN_QUEUE_CHUNKS, overflow: OverflowPolicy = 'drop_oldest', preroll: float = 0) -> ListenSubscriber:
+		subscriber = super().subscribe(max_chunks, overflow)
+		if self.encoder is not None:
+			# Late joiners need the stream headers before any audio page
+			for page in self.encoder.header:
+				subscriber.offer(page)
+		return subscriber
+
+
+_hubs: dict[tuple[int, ListenKey], ListenHub] = dict()
+
+def get_hub(output: AudioOutput, key: ListenKey, history: Optional[AudioHistory] = None) -> ListenHub:
+	if key.encoding == 'opus':
+		# The encoder takes the output as is, so only channels and bitrate tell opus streams apart
+		key = replace(key, rate=output.rate, chunk_size=max(1, int(output.rate * OPUS_DRAIN_SECONDS)), format='f32')
+	hub = _hubs.get((id(output), key))
+	if hub is None:
+		hub_class = OpusListenHub if key.encoding == 'opus' else ListenHub
+		hub = hub_class(output, key, history)
+		_hubs[(id(output), key)] = hub
+	return hub
+
+def get_hubs(output: AudioOutput) -> list[ListenHub]:
+	return [hub for (output_id, _), hub in _hubs.items() if output_id == id(output)]
+
+def downgrade(subscriber: ListenSubscriber) -> Optional[ListenSubscriber]:
+	'''Moves an overflowed subscriber to the hub with half its rate, keeping its counters'''
+	hub = subscriber.hub
+	key = hub.key.lower()
+	if key is None:
+		return None
+	lower = get_hub(hub.output, key, hub.history).subscribe(subscriber.max_chunks, subscriber.overflow)
+	lower.sent = subscriber.sent
+	lower.dropped = subscriber.dropped
+	lower.downgrades = subscriber.downgrades + 1
+	subscriber.close()
+	return lower
@@ -0,0 +1,151 @@
+import queue
+import threading
+from datetime import datetime
+from pathlib import Path
+from typing import Literal, Optional, TYPE_CHECKING
+
+import numpy as np
+from pydantic import BaseModel, Field
+import soundfile as sf
+
+from bmaster import configs, logs
+
+if TYPE_CHECKING:
+	from bmaster.icoms.queries import Query
+
+
+logger = logs.main_logger.getChild('recording')
+
+# How long to wait for the writer thread to flush when a recording ends
+CLOSE_TIMEOUT = 5.0
+
+
+class RecordingConfig(BaseModel):
+	enabled: bool = False
+	path: Path = Path('data/recordings')
+	format: Literal['flac', 'opus'] = 'flac'
+	# Audio kept in memory while the disk is busy, frames beyond it are dropped
+	queue_seconds: float = Field(default=5.0, gt=0)
+
+config: Optional[RecordingConfig] = None
+
+_FORMATS = {
+	'flac': ('.flac', 'FLAC', 'PCM_16'),
+	'opus': ('.opus', 'OGG', 'OPUS'),
+}
+
+
+class RecordingInfo(BaseModel):
+	file: str
+	query: str
+	type: Optional[str]
+	icom: str
+	author: Optional[dict]
+	rate: int
+	channels: int
+	started_at: datetime
+	ended_at: Optional[datetime] = None
+	samples: int = 0
+	dropped_samples: int = 0
+	error: Optional[str] = None
+
+
+class Recording:
+	'''Writes audio pushed from the event loop to a compressed file on a background thread'''
+	path: Path
+	info: RecordingInfo
+	closed: bool = False
+
+	def __init__(self, path: Path, rate: int, channels: int, info: RecordingInfo, queue_seconds: float):
+		self.path = path
+		self.rate = rate
+		self.channels = channels
+		self.info = info
+		# Capacity is counted as if every block was 10 ms long, real blocks are larger
+		self._queue: queue.Queue[Optional[np.ndarray]] = queue.Queue(maxsize=max(1, int(queue_seconds * 100)))
+		self._thread = threading.Thread(target=self._run, name=f'recording-{info.query}', daemon=True)
+		self._thread.start()
+
+	def write(self, data: np.ndarray):
+		'''Never blocks: if the writer falls behind the block is dropped and counted'''
+		if self.closed:
+			return
+		try:
+			self._queue.put_nowait(data)
+		except queue.Full:
+			self.info.dropped_samples += len(data)
+
+	def close(self):
+		if self.closed:
+			return
+		self.closed = True
+		self.info.ended_at = datetime.now()
+		threading.Thread(target=self._finish, daemon=True).start()
+
+	def _finish(self):
+		# Waits for room instead of dropping the end of stream marker
+		self._queue.put(None)
+		self._thread.join(CLOSE_TIMEOUT)
+
+	def _run(self):
+		info = self.info
+		_, file_format, subtype = _FORMATS[config.format]
+		try:
+			self.path.parent.mkdir(parents=True, exist_ok=True)
+			with sf.SoundFile(
+				self.path, 'w',
+				samplerate=self.rate,
+				channels=self.channels,
+				format=file_format,
+				subtype=subtype
+			) as f:
+				while True:
+					data = self._queue.get()
+					if data is None: break
+					f.write(data)
+					info.samples += len(data)
+		except Exception as e:
+			logger.error(f'Recording {self.path} failed', exc_info=e)
+			info.error = str(e)
+			# Keep draining so the producer side never stalls
+			while self._queue.get() is not None: pass
+
+		if info.dropped_samples:
+			logger.warning(f'Recording {self.path} dropped {info.dropped_samples} samples')
+		try:
+			meta_path = self.path.with_suffix(self.path.suffix + '.json')
+			meta_path.write_text(info.model_dump_json(indent=2), encoding='utf8')
+		except Exception as e:
+			logger.error(f'Failed to write recording metadata for {self.path}', exc_info=e)
+
+
+def start_recording(query: 'Query', rate: int, channels: int) -> Optional[Recording]:
+	'''Starts recording a live query if recording is enabled'''
+	if config is None or not config.enabled:
+		return None
+
+	if config.format == 'opus' and rate not in (8000, 12000, 16000, 24000, 48000):
+		logger.error(f'Opus recording does not support {rate} Hz, query {query.id} is not recorded')
+		return None
+
+	now = datetime.now()
+	ext = _FORMATS[config.format][0]
+	path = config.path / now.strftime('%Y-%m-%d') / f"{now.strftime('%H%M%S')}-{query.icom.id}-{query.id.hex[:8]}{ext}"
+	info = RecordingInfo(
+		file=str(path),
+		query=str(query.id),
+		type=query.type,
+		icom=query.icom.id,
+		author=query.author.model_dump() if query.author else None,
+		rate=rate,
+		channels=channels,
+		started_at=now
+	)
+	return Recording(path, rate, channels, info, config.queue_seconds)
+
+
+async def start():
+	global config
+	config = RecordingConfig.model_validate(configs.get('recording', None) or {})
+	if config.enabled:
+		logger.info(f"Recording live announcements to '{config.path}' ({config.format})")
@@ -1,27 +1,377 @@
+import asyncio
+import hashlib
+import multiprocessing
+import os
+import shutil
+import subprocess
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
 from pathlib import Path
+from typing import Callable, Literal, Optional
+import numpy as np
+import soundfile as sf
+from pydantic import BaseModel
+from sqlalchemy import Float, Integer, Text, delete, select
+from sqlalchemy.orm import Mapped, mapped_column
+from wauxio import Audio
 from wauxio.storage import FileSoundStorage
 from wauxio.codecs.mp3 import from_mp3
 from wauxio.codecs.any import from_any
 
-from bmaster import logs
+from bmaster import configs, database, logs
+from bmaster.database import Base
 
 
 logger = logs.main_logger.getChild('sounds')
 
 root = Path('data/sounds')
+# Uploads are written here first, on the same filesystem so they can be renamed into root
+uploads_root = root / '.uploads'
+# Every sound converted once to the icom format, mounting reads these instead of decoding the originals.
+# Playback keeps using the originals, the system player plays them in their own channel layout.
+canonical_root = root / '.canonical'
+CANONICAL_RATE = 48000
 storage = FileSoundStorage(
 	root=root,
 	hide_ext=False
 )
 
+# Same codecs as the storage uses on mount, by lowercase file suffix
+_codecs: dict[str, Callable[[Path], Audio]] = {
+	'.mp3': from_mp3,
+}
 
 storage.use_sync_codec('.mp3', from_mp3)
 storage.use_sync_codec('*', from_any)
 
 
+class SoundsConfig(BaseModel):
+	# Largest accepted upload in megabytes
+	max_upload_mb: float = 100
+
+	@property
+	def max_upload_size(self) -> int:
+		return int(self.max_upload_mb * 1024 * 1024)
+
+config: Optional[SoundsConfig] = None
+
+
+class SoundMeta(BaseModel):
+	name: str
+	size: int
+	mtime: float
+	# Unknown until the file is decoded
+	duration: Optional[float] = None
+	rate: Optional[int] = None
+	channels: Optional[int] = None
+	peak: Optional[float] = None
+	# RMS level in dBFS, None for silent files
+	loudness_db: Optional[float] = None
+	# sha256 of the file
+	hash: Optional[str] = None
+
+class SoundMetaRecord(Base):
+	__tablename__ = 'sound_meta'
+
+	name: Mapped[str] = mapped_column(Text, primary_key=True)
+	size: Mapped[int] = mapped_column(Integer, nullable=False)
+	mtime: Mapped[float] = mapped_column(Float, nullable=False)
+	duration: Mapped[float] = mapped_column(Float, nullable=False)
+	rate: Mapped[int] = mapped_column(Integer, nullable=False)
+	channels: Mapped[int] = mapped_column(Integer, nullable=False)
+	peak: Mapped[float] = mapped_column(Float, nullable=False)
+	loudness_db: Mapped[Optional[float]] = mapped_column(Float, nullable=True)
+	hash: Mapped[str] = mapped_column(Text, nullable=False)
+
+	def to_meta(self) -> SoundMeta:
+		return SoundMeta(
+			name=self.name,
+			size=self.size,
+			mtime=self.mtime,
+			duration=self.duration,
+			rate=self.rate,
+			channels=self.channels,
+			peak=self.peak,
+			loudness_db=self.loudness_db,
+			hash=self.hash
+		)
+
+# Metadata of every sound file by name, mirrors the sound_meta table
+index: dict[str, SoundMeta] = dict()
+
+
+def _decode(path: Path) -> Audio:
+	codec = _codecs.get(path.suffix.lower(), from_any)
+	return codec(path)
+
+def canonical_path(name: str) -> Path:
+	return canonical_root / f'{name}.wav'
+
+def _is_canonical_fresh(path: Path, canonical: Path) -> bool:
+	try: return canonical.stat().st_mtime >= path.stat().st_mtime
+	except FileNotFoundError: return False
+
+def _transcode(path: Path, canonical: Path) -> Audio:
+	'''Converts a sound to the canonical format and stores the result as float32 WAV.
+	Done once per file, so it uses the band-limited resampler of ffmpeg rather than the streaming ones.'''
+	result = subprocess.run(
+		[
+			'ffmpeg',
+			'-hide_banner',
+			'-loglevel',
+			'error',
+			'-i',
+			str(path),
+			'-vn',
+			'-ac',
+			'1',
+			'-ar',
+			str(CANONICAL_RATE),
+			'-f',
+			'f32le',
+			'pipe:1',
+		],
+		capture_output=True
+	)
+	if result.returncode != 0:
+		detail = result.stderr.decode(errors='replace').strip()
+		raise RuntimeError(f'ffmpeg transcode failed: {detail}')
+	data = np.frombuffer(result.stdout, dtype='<f4')
+
+	# Written aside and renamed so a reader never sees a partial file
+	temp = canonical.with_name(f'.{uuid.uuid4().hex}.part')
+	sf.write(temp, data, CANONICAL_RATE, subtype='FLOAT', format='WAV')
+	os.replace(temp, canonical)
+	return Audio(data, CANONICAL_RATE)
+
+def _file_hash(path: Path) -> str:
+	digest = hashlib.sha256()
+	with open(path, 'rb') as f:
+		while chunk := f.read(1 << 20):
+			digest.update(chunk)
+	return digest.hexdigest()
+
+def _load(path: Path, analyze: bool) -> tuple[Audio, Optional[SoundMeta]]:
+	'''Loads the canonical form of a sound, transcoding the original when it is missing or stale,
+	and measures the original for the index if `analyze` is set. Runs in worker processes.
+	Falls back to the wauxio codecs when ffmpeg is not installed.'''
+	stat = path.stat()
+	canonical = canonical_path(path.name)
+	if not analyze and _is_canonical_fresh(path, canonical):
+		data, _ = sf.read(canonical, dtype='float32')
+		return Audio(data, CANONICAL_RATE), None
+
+	# Without ffmpeg the decoded original is used as is, a canonical copy is only stored when it is resampled well
+	audio = _transcode(path, canonical) if shutil.which('ffmpeg') else None
+	if not analyze and audio is not None:
+		return audio, None
+
+	source = _decode(path)
+	if audio is None:
+		audio = source
+	if not analyze:
+		return audio, None
+	data = np.asarray(source.data, dtype=np.float32)
+	peak = float(np.abs(data).max()) if data.size else 0.0
+	rms = float(np.sqrt(np.mean(np.square(data)))) if data.size else 0.0
+	return audio, SoundMeta(
+		name=path.name,
+		size=stat.st_size,
+		mtime=stat.st_mtime,
+		duration=source.duration,
+		rate=source.rate,
+		channels=data.shape[1] if data.ndim > 1 else 1,
+		peak=round(peak, 6),
+		loudness_db=round(20 * np.log10(rms), 2) if rms > 0 else None,
+		hash=_file_hash(path)
+	)
+
+def _is_indexed(path: Path, stat: os.stat_result) -> bool:
+	meta = index.get(path.name)
+	return meta is not None and meta.hash is not None and meta.size == stat.st_size and meta.mtime == stat.st_mtime
+
+
+async def _save_meta(meta: SoundMeta):
+	index[meta.name] = meta
+	async with database.LocalSession() as session, session.begin():
+		await session.merge(SoundMetaRecord(**meta.model_dump()))
+
+async def _delete_meta(*names: str):
+	for name in names:
+		index.pop(name, None)
+	async with database.LocalSession() as session, session.begin():
+		await session.execute(delete(SoundMetaRecord).where(SoundMetaRecord.name.in_(names)))
+
+async def _load_index():
+	async with database.engine.begin() as conn:
+		# The mount runs before the models are created on startup
+		await conn.run_sync(SoundMetaRecord.__table__.create, checkfirst=True)
+	async with database.LocalSession() as session:
+		records = (await session.execute(select(SoundMetaRecord))).scalars().all()
+	index.clear()
+	for record in records:
+		index[record.name] = record.to_meta()
+
+
+# Serializes add and remove of the same sound, a removal waits for a decode in progress
+_name_locks: dict[str, asyncio.Lock] = dict()
+
+def _lock(name: str) -> asyncio.Lock:
+	lock = _name_locks.get(name)
+	if lock is None:
+		lock = _name_locks[name] = asyncio.Lock()
+	return lock
+
+async def _remove(name: str):
+	storage.sounds.pop(name, None)
+	canonical_path(name).unlink(missing_ok=True)
+	await _delete_meta(name)
+
+async def add(name: str) -> bool:
+	'''Decodes a single sound off the event loop and adds it to the storage, replacing any previous entry'''
+	path = root / name
+	async with _lock(name):
+		try:
+			audio, meta = await asyncio.to_thread(_load, path, True)
+		except Exception as e:
+			logger.error(f"Failed to decode sound '{name}'", exc_info=e)
+			await _remove(name)
+			# Still listed without specs so it can be deleted, like files that fail on mount
+			if path.exists():
+				stat = path.stat()
+				index[name] = SoundMeta(name=name, size=stat.st_size, mtime=stat.st_mtime)
+			return False
+		# Deleted while it was decoding, the canonical copy was written after the removal
+		if not path.exists():
+			await _remove(name)
+			return False
+		storage.sounds[name] = audio
+		await _save_meta(meta)
+		return True
+
+async def remove(name: str):
+	async with _lock(name):
+		await _remove(name)
+
+
+# Finished jobs kept for the status endpoint
+JOBS_KEEP = 100
+
+SoundJobStatus = Literal['pending', 'processing', 'done', 'failed']
+
+class SoundJob(BaseModel):
+	id: uuid.UUID
+	name: str
+	status: SoundJobStatus = 'pending'
+	error: Optional[str] = None
+	created_at: datetime
+	finished_at: Optional[datetime] = None
+
+jobs: dict[uuid.UUID, SoundJob] = dict()
+_job_tasks: set[asyncio.Task] = set()
+
+async def _run_job(job: SoundJob):
+	job.status = 'processing'
+	try:
+		ok = await add(job.name)
+	except Exception as e:
+		logger.error(f"Sound job for '{job.name}' failed", exc_info=e)
+		ok = False
+	job.status = 'done' if ok else 'failed'
+	if not ok: job.error = 'Failed to decode sound'
+	job.finished_at = datetime.now()
+
+	finished = [id for id, other in jobs.items() if other.finished_at is not None]
+	for id in finished[:max(0, len(finished) - JOBS_KEEP)]:
+		del jobs[id]
+
+def submit(name: str) -> SoundJob:
+	'''Probes and decodes an uploaded sound in the background, the returned job tracks its status'''
+	job = SoundJob(id=uuid.uuid4(), name=name, created_at=datetime.now())
+	jobs[job.id] = job
+	task = asyncio.create_task(_run_job(job))
+	_job_tasks.add(task)
+	task.add_done_callback(_job_tasks.discard)
+	return job
+
+
+class MountProgress(BaseModel):
+	total: int = 0
+	decoded: int = 0
+	failed: int = 0
+	# Files that were new or changed since the index was last updated
+	indexed: int = 0
+	workers: int = 0
+	started_at: Optional[datetime] = None
+	finished_at: Optional[datetime] = None
+	seconds: Optional[float] = None
+
+progress = MountProgress()
+_mount_task: Optional[asyncio.Task] = None
+
+
+async def _mount(paths: list[Path]):
+	'''Decodes the library on a process pool, every sound becomes playable as soon as it is decoded'''
+	loop = asyncio.get_running_loop()
+	started = time.monotonic()
+
+	await _load_index()
+	stats = {path.name: path.stat() for path in paths}
+	gone = [name for name in index if name not in stats]
+	if gone:
+		await _delete_meta(*gone)
+	for canonical in canonical_root.iterdir():
+		if canonical.name.removesuffix('.wav') not in stats:
+			canonical.unlink()
+	for path in paths:
+		stat = stats[path.name]
+		if not _is_indexed(path, stat):
+			index[path.name] = SoundMeta(name=path.name, size=stat.st_size, mtime=stat.st_mtime)
+
+	# Forking a process that runs audio and worker threads can deadlock the children
+	context = multiprocessing.get_context('spawn' if os.name == 'nt' else 'forkserver')
+	with ProcessPoolExecutor(max_workers=progress.workers, mp_context=context) as pool:
+		async def _mount_one(path: Path):
+			analyze = not _is_indexed(path, stats[path.name])
+			try:
+				audio, meta = await loop.run_in_executor(pool, _load, path, analyze)
+			except Exception as e:
+				logger.error(f"Failed to decode sound '{path.name}'", exc_info=e)
+				progress.failed += 1
+				return
+			# Deleted through the API while it was decoding
+			if not path.exists(): return
+			storage.sounds[path.name] = audio
+			progress.decoded += 1
+			if meta is not None:
+				await _save_meta(meta)
+				progress.indexed += 1
+
+		await asyncio.gather(*map(_mount_one, paths))
+
+	progress.finished_at = datetime.now()
+	progress.seconds = round(time.monotonic() - started, 3)
+	logger.info(
+		f'Sound storage mounted: {progress.decoded} sounds ({progress.indexed} reindexed), '
+		f'{progress.failed} failed, {progress.seconds} s on {progress.workers} workers'
+	)
+
+
 async def start():
-	logger.info('Mounting sound storage...')
-	# await storage.mount()
-	storage.mount_sync()
-	logger.info(storage.sounds)
-	logger.info('Sound storage mounted')
+	global config, _mount_task
+	config = SoundsConfig.model_validate(configs.get('sounds', None) or {})
+	root.mkdir(parents=True, exist_ok=True)
+	# Left over from uploads interrupted by a restart
+	if uploads_root.exists():
+		for path in uploads_root.iterdir():
+			path.unlink()
+	uploads_root.mkdir(exist_ok=True)
+	canonical_root.mkdir(exist_ok=True)
+	paths = [path for path in root.iterdir() if path.is_file()]
+	progress.total = len(paths)
+	progress.workers = max(1, min(os.cpu_count() or 1, len(paths)))
+	progress.started_at = datetime.now()
+	logger.info(f'Mounting {len(paths)} sounds in the background...')
+	_mount_task = asyncio.create_task(_mount(paths))
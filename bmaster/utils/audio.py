@@ -0,0 +1,228 @@
+from typing import Optional
+
+import numpy as np
+
+
+def _ulaw_table() -> np.ndarray:
+	u = (~np.arange(256, dtype=np.uint8)).astype(np.int32)
+	exponent = (u >> 4) & 0x07
+	mantissa = u & 0x0F
+	magnitude = (((mantissa << 3) + 0x84) << exponent) - 0x84
+	return (np.where(u & 0x80, -magnitude, magnitude) / 32768).astype(np.float32)
+
+def _alaw_table() -> np.ndarray:
+	a = (np.arange(256, dtype=np.uint8) ^ 0x55).astype(np.int32)
+	exponent = (a >> 4) & 0x07
+	mantissa = a & 0x0F
+	magnitude = np.where(
+		exponent == 0,
+		(mantissa << 4) + 8,
+		((mantissa << 4) + 0x108) << np.maximum(exponent - 1, 0)
+	)
+	return (np.where(a & 0x80, magnitude, -magnitude) / 32768).astype(np.float32)
+
+# G.711 byte -> float32 sample lookup tables
+ULAW_TABLE = _ulaw_table()
+ALAW_TABLE = _alaw_table()
+
+
+def decode_ulaw(payload: bytes) -> np.ndarray:
+	return ULAW_TABLE[np.frombuffer(payload, dtype=np.uint8)]
+
+def decode_alaw(payload: bytes) -> np.ndarray:
+	return ALAW_TABLE[np.frombuffer(payload, dtype=np.uint8)]
+
+def decode_l16(payload: bytes) -> np.ndarray:
+	'''Decodes network byte order signed 16-bit PCM'''
+	size = len(payload) - len(payload) % 2
+	return np.frombuffer(payload[:size], dtype='>i2').astype(np.float32) / 32768
+
+
+class LinearResampler:
+	'''Streaming linear interpolation resampler for float32 blocks.
+	Mono blocks come out flat, multichannel blocks as (samples, channels).'''
+	# Input samples per output sample
+	step: float
+	channels: int
+
+	def __init__(self, src_rate: int, dst_rate: int, channels: int = 1):
+		self.step = src_rate / dst_rate
+		self.channels = channels
+		self._last = np.zeros((1, channels), dtype=np.float32)
+		# Position of the next output sample relative to `_last`
+		self._pos = 0.0
+
+	def process(self, data: np.ndarray) -> np.ndarray:
+		src = np.concatenate((self._last, data.reshape((-1, self.channels))))
+		end = len(src) - 1
+		count = int(np.ceil((end - self._pos) / self.step)) if end > self._pos else 0
+		positions = self._pos + np.arange(count) * self.step
+		index = np.arange(len(src))
+		self._pos += count * self.step - end
+		self._last = src[-1:]
+		if self.channels == 1:
+			return np.interp(positions, index, src[:, 0]).astype(np.float32)
+		out = np.empty((count, self.channels), dtype=np.float32)
+		for channel in range(self.channels):
+			out[:, channel] = np.interp(positions, index, src[:, channel])
+		return out
+
+	def passthrough(self, data: np.ndarray) -> np.ndarray:
+		'''Passes a block through unchanged at step 1 with the same one sample delay as `process`,
+		so the stream stays continuous when switching between the two'''
+		src = np.concatenate((self._last, data.reshape((-1, self.channels))))
+		self._last = src[-1:]
+		self._pos = 0.0
+		out = src[:-1]
+		return out[:, 0] if self.channels == 1 else out
+
+
+class BlockDecimator:
+	'''Downsamples float32 blocks by an integer factor, averaging each group of samples.
+	Mono blocks come out flat, multichannel blocks as (samples, channels).'''
+	factor: int
+	channels: int
+
+	def __init__(self, factor: int, channels: int = 1):
+		self.factor = factor
+		self.channels = channels
+		self._rest = np.zeros((0, channels), dtype=np.float32)
+
+	def process(self, data: np.ndarray) -> np.ndarray:
+		src = np.concatenate((self._rest, data.reshape((-1, self.channels))))
+		size = len(src) - len(src) % self.factor
+		self._rest = src[size:]
+		out = src[:size].reshape((-1, self.factor, self.channels)).mean(axis=1, dtype=np.float32)
+		return out[:, 0] if self.channels == 1 else out
+
+
+def make_resampler(src_rate: int, dst_rate: int, channels: int = 1) -> Optional[LinearResampler | BlockDecimator]:
+	'''Picks the cheapest streaming resampler for the rates, None if they are equal'''
+	if src_rate == dst_rate:
+		return None
+	if src_rate > dst_rate and src_rate % dst_rate == 0:
+		return BlockDecimator(src_rate // dst_rate, channels)
+	return LinearResampler(src_rate, dst_rate, channels)
+
+
+def to_s16(data: np.ndarray) -> np.ndarray:
+	return (np.clip(data, -1.0, 1.0) * 32767).astype('<i2')
+
+
+class GainRamp:
+	'''Block gain that glides to a new value over a few milliseconds instead of jumping, avoiding clicks'''
+	gain: float
+	target: float
+	# Gain change per sample while ramping
+	_step: float = 0.0
+
+	def __init__(self, ramp_samples: int, gain: float = 1.0):
+		self.ramp_samples = max(1, ramp_samples)
+		self.gain = gain
+		self.target = gain
+
+	def set(self, gain: float):
+		self.target = gain
+		self._step = (gain - self.gain) / self.ramp_samples
+
+	def process(self, data: np.ndarray) -> np.ndarray:
+		'''Returns a scaled copy of (samples, channels) data, or the data itself at unity gain'''
+		if self.gain == self.target:
+			if self.gain == 1.0:
+				return data
+			return data * np.float32(self.gain)
+
+		size = len(data)
+		count = min(size, int(np.ceil((self.target - self.gain) / self._step)))
+		envelope = np.full(size, self.target, dtype=np.float32)
+		ramp = self.gain + self._step * np.arange(1, count + 1)
+		envelope[:count] = np.clip(ramp, min(self.gain, self.target), max(self.gain, self.target))
+		last = float(envelope[-1])
+		# Snap to the target once it is less than a step away
+		self.gain = self.target if abs(self.target - last) <= abs(self._step) else last
+		return data * envelope.reshape((-1,) + (1,) * (data.ndim - 1))
+
+
+class LevelMeter:
+	'''Accumulates per-channel peak and RMS of the blocks passing through until they are taken'''
+	channels: int
+
+	def __init__(self, channels: int):
+		self.channels = channels
+		self._peak = np.zeros(channels, dtype=np.float32)
+		self._squares = np.zeros(channels, dtype=np.float64)
+		self._samples = 0
+
+	def update(self, data: np.ndarray):
+		data = data.reshape((-1, self.channels))
+		if not len(data): return
+		np.maximum(self._peak, np.abs(data).max(axis=0), out=self._peak)
+		self._squares += np.einsum('ij,ij->j', data, data, dtype=np.float64)
+		self._samples += len(data)
+
+	def take(self) -> tuple[list[float], list[float]]:
+		'''Returns (peak, rms) per channel since the last call and starts over'''
+		peak = self._peak.tolist()
+		rms = np.sqrt(self._squares / self._samples).tolist() if self._samples else [0.0] * self.channels
+		self._peak.fill(0)
+		self._squares.fill(0)
+		self._samples = 0
+		return peak, rms
+
+
+def db_to_amplitude(db: float) -> float:
+	return 10 ** (db / 20)
+
+
+class SilenceDetector:
+	'''Measures continuous silence of a stream block by block.
+	A block below the threshold starts silence, only a block louder than threshold + hysteresis ends it,
+	so speech pauses hovering around the threshold do not flicker.'''
+	rate: int
+	silent: bool = False
+	silent_samples: int = 0
+
+	def __init__(self, rate: int, threshold_db: float, hysteresis_db: float):
+		self.rate = rate
+		self.close_level = db_to_amplitude(threshold_db)
+		self.open_level = db_to_amplitude(threshold_db + hysteresis_db)
+
+	@property
+	def silent_seconds(self) -> float:
+		return self.silent_samples / self.rate
+
+	def update(self, data: np.ndarray) -> float:
+		'''Returns the seconds of silence so far'''
+		if not data.size:
+			return self.silent_seconds
+		rms = float(np.sqrt(np.mean(np.square(data, dtype=np.float32))))
+		if self.silent:
+			if rms > self.open_level:
+				self.silent = False
+				self.silent_samples = 0
+		elif rms < self.close_level:
+			self.silent = True
+		if self.silent:
+			self.silent_samples += len(data)
+		return self.silent_seconds
+
+
+def trim_silence(data: np.ndarray, rate: int, threshold_db: float, padding: float, block_seconds: float = 0.01) -> np.ndarray:
+	'''Cuts leading and trailing blocks whose RMS is below the threshold, keeping `padding` seconds around the sound.
+	Returns an empty slice if everything is silent.'''
+	block = max(1, int(rate * block_seconds))
+	frames = data.reshape((len(data), -1))
+	count = len(frames) // block
+	if not count:
+		return data
+	blocks = frames[:count * block].reshape((count, -1))
+	rms = np.sqrt(np.mean(np.square(blocks, dtype=np.float32), axis=1))
+	loud = np.flatnonzero(rms >= db_to_amplitude(threshold_db))
+	if not len(loud):
+		return data[:0]
+
+	pad = int(padding * rate)
+	start = max(0, loud[0] * block - pad)
+	# The partial block at the end is never judged, keep it if the sound reaches it
+	end = len(data) if loud[-1] == count - 1 else min(len(data), (loud[-1] + 1) * block + pad)
+	return data[start:end]
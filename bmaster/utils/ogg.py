@@ -0,0 +1,128 @@
+import struct
+from typing import Optional
+
+
+def _crc_table() -> list[int]:
+	table = []
+	for i in range(256):
+		r = i << 24
+		for _ in range(8):
+			r = ((r << 1) ^ 0x04C11DB7) if r & 0x80000000 else r << 1
+		table.append(r & 0xFFFFFFFF)
+	return table
+
+_CRC_TABLE = _crc_table()
+
+def ogg_crc(data: bytes) -> int:
+	crc = 0
+	for byte in data:
+		crc = ((crc << 8) & 0xFFFFFFFF) ^ _CRC_TABLE[((crc >> 24) ^ byte) & 0xFF]
+	return crc
+
+
+_PAGE_HEADER = struct.Struct('<4sBBqIIIB')
+
+HEADER_BOS = 0x02
+HEADER_EOS = 0x04
+
+
+def build_page(packet: bytes, granule: int, serial: int, sequence: int, header_type: int = 0) -> bytes:
+	'''Builds an Ogg page holding a single packet'''
+	lacing = bytes([255] * (len(packet) // 255) + [len(packet) % 255])
+	header = _PAGE_HEADER.pack(b'OggS', 0, header_type, granule, serial, sequence, 0, len(lacing))
+	page = bytearray(header + lacing + packet)
+	struct.pack_into('<I', page, 22, ogg_crc(page))
+	return bytes(page)
+
+
+def opus_head(channels: int, input_rate: int, pre_skip: int = 312) -> bytes:
+	return b'OpusHead' + struct.pack('<BBHIhB', 1, channels, pre_skip, input_rate, 0, 0)
+
+def opus_tags(vendor: str = 'bmaster') -> bytes:
+	vendor_bytes = vendor.encode()
+	return b'OpusTags' + struct.pack('<I', len(vendor_bytes)) + vendor_bytes + struct.pack('<I', 0)
+
+
+# Frame durations in 48 kHz samples for each TOC config (RFC 6716 3.1): SILK, hybrid, CELT
+_OPUS_FRAME_SAMPLES = [480, 960, 1920, 2880] * 3 + [480, 960] * 2 + [120, 240, 480, 960] * 4
+
+def opus_packet_samples(packet: bytes) -> int:
+	'''Duration of an Opus packet in 48 kHz samples, read from its TOC byte'''
+	if not packet:
+		return 0
+	toc = packet[0]
+	code = toc & 0x03
+	if code == 0:
+		frames = 1
+	elif code < 3:
+		frames = 2
+	else:
+		frames = packet[1] & 0x3F if len(packet) > 1 else 0
+	return frames * _OPUS_FRAME_SAMPLES[toc >> 3]
+
+
+class OggOpusWriter:
+	'''Wraps raw Opus packets into an Ogg stream'''
+	serial: int
+	channels: int
+	sequence: int = 0
+	started: bool = False
+
+	def __init__(self, serial: int, channels: int = 1):
+		self.serial = serial
+		self.channels = channels
+
+	def _page(self, packet: bytes, granule: int, header_type: int = 0) -> bytes:
+		page = build_page(packet, granule, self.serial, self.sequence, header_type)
+		self.sequence += 1
+		return page
+
+	def write(self, packet: bytes, granule: int) -> bytes:
+		'''Returns Ogg pages for the packet, prefixed with stream headers on the first call'''
+		res = b''
+		if not self.started:
+			self.started = True
+			res += self._page(opus_head(self.channels, 48000), 0, HEADER_BOS)
+			res += self._page(opus_tags(), 0)
+		return res + self._page(packet, granule)
+
+
+
+class OggPageReader:
+	'''Splits an Ogg byte stream into whole pages'''
+
+	def __init__(self):
+		self._buffer = bytearray()
+
+	def feed(self, data: bytes) -> list[bytes]:
+		buffer = self._buffer
+		buffer.extend(data)
+		pages = []
+		while True:
+			start = buffer.find(b'OggS')
+			if start < 0:
+				# Keep a possible partial capture pattern
+				del buffer[:max(0, len(buffer) - 3)]
+				break
+			if start:
+				del buffer[:start]
+			size = _page_size(buffer)
+			if size is None or len(buffer) < size:
+				break
+			pages.append(bytes(buffer[:size]))
+			del buffer[:size]
+		return pages
+
+
+def _page_size(buffer: bytearray) -> Optional[int]:
+	header_size = _PAGE_HEADER.size
+	if len(buffer) < header_size:
+		return None
+	segments = buffer[header_size - 1]
+	if len(buffer) < header_size + segments:
+		return None
+	return header_size + segments + sum(buffer[header_size:header_size + segments])
+
+
+def page_granule(page: bytes) -> int:
+	return _PAGE_HEADER.unpack_from(page)[3]
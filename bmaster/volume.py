@@ -0,0 +1,132 @@
+import asyncio
+import platform
+import re
+import subprocess
+from typing import Optional
+
+from pydantic import BaseModel
+from sqlalchemy import Integer, Text, select
+from sqlalchemy.orm import Mapped, mapped_column
+
+from bmaster import configs, direct, icoms, logs
+from bmaster.database import Base
+
+
+logger = logs.main_logger.getChild('volume')
+
+MASTER = 'master'
+ICOM_PREFIX = 'icom:'
+
+
+class VolumeConfig(BaseModel):
+	# Set the master volume on the system mixer with pactl instead of the software gain of direct outputs.
+	# Sound files are played by the system player, so only the system mixer volume reaches them.
+	hardware: bool = True
+
+config: Optional[VolumeConfig] = None
+
+# Last set master volume
+master: int = 100
+
+
+class VolumeSetting(Base):
+	__tablename__ = 'volume_setting'
+
+	# 'master' or 'icom:<icom id>'
+	name: Mapped[str] = mapped_column(Text, primary_key=True)
+	volume: Mapped[int] = mapped_column(Integer, nullable=False)
+
+
+def _gain(volume: int) -> float:
+	return volume / 100
+
+async def get_master() -> int:
+	'''The system mixer volume when hardware volume is enabled, the last set master volume otherwise'''
+	if config.hardware:
+		volume = await asyncio.to_thread(_get_hardware_volume)
+		if volume is not None:
+			return volume
+	return master
+
+def get_icom(icom: icoms.Icom) -> int:
+	return round(icom.gain.target * 100)
+
+
+def _set_hardware_volume(volume: int) -> bool:
+	if platform.system() != 'Linux':
+		return False
+	try:
+		subprocess.run(
+			['pactl', 'set-sink-volume', '@DEFAULT_SINK@', f'{volume}%'],
+			check=True,
+			stdout=subprocess.DEVNULL,
+			stderr=subprocess.DEVNULL,
+		)
+	except Exception:
+		return False
+	return True
+
+def _get_hardware_volume() -> Optional[int]:
+	if platform.system() != 'Linux':
+		return None
+	try:
+		result = subprocess.run(
+			['pactl', 'get-sink-volume', '@DEFAULT_SINK@'],
+			capture_output=True,
+			text=True,
+			check=True,
+		)
+	except Exception:
+		return None
+	match = re.search(r'(\d+)%', result.stdout)
+	return int(match.group(1)) if match else None
+
+async def _save(name: str, volume: int):
+	from bmaster.database import LocalSession
+	async with LocalSession() as session, session.begin():
+		await session.merge(VolumeSetting(name=name, volume=volume))
+
+async def _apply_master(volume: int) -> bool:
+	global master
+	if config.hardware:
+		# Direct outputs play through the system mixer as well, the software gain stays at unity
+		# so they are not attenuated twice. pactl blocks for a while, keep it off the event loop.
+		if not await asyncio.to_thread(_set_hardware_volume, volume):
+			return False
+	else:
+		direct.set_master_gain(_gain(volume))
+	master = volume
+	return True
+
+async def set_master(volume: int) -> bool:
+	'''Sets the system mixer volume when hardware volume is enabled, the software gain of direct outputs otherwise.
+	Nothing is changed or saved when the system mixer could not be set.'''
+	if not await _apply_master(volume):
+		return False
+	await _save(MASTER, volume)
+	return True
+
+async def set_icom(icom: icoms.Icom, volume: int):
+	'''Sets the gain of the icom mix. Sound queries are played by the system player
+	outside of the mix, so it does not apply to sound files.'''
+	icom.gain.set(_gain(volume))
+	await _save(ICOM_PREFIX + icom.id, volume)
+
+
+async def load():
+	'''Restores saved volumes, needs the database models to be created'''
+	from bmaster.database import LocalSession
+	async with LocalSession() as session:
+		settings = (await session.execute(select(VolumeSetting))).scalars().all()
+
+	for setting in settings:
+		if setting.name == MASTER:
+			await _apply_master(setting.volume)
+		elif setting.name.startswith(ICOM_PREFIX):
+			icom = icoms.get(setting.name[len(ICOM_PREFIX):])
+			if icom: icom.gain.set(_gain(setting.volume))
+	logger.debug(f'Restored {len(settings)} volume settings')
+
+async def start():
+	global config
+	config = VolumeConfig.model_validate(configs.get('volume', None) or {})